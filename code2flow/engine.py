@@ -2,6 +2,7 @@ import argparse
 import collections
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
@@ -12,7 +13,8 @@ from .javascript import Javascript
 from .ruby import Ruby
 from .php import PHP
 from .model import (TRUNK_COLOR, LEAF_COLOR, NODE_COLOR, GROUP_TYPE, OWNER_CONST,
-                    Edge, Group, Node, Variable, is_installed, flatten)
+                    Edge, FileSummary, Group, Node, SymbolTable, Variable, is_installed,
+                    flatten)
 
 VERSION = '2.5.1'
 
@@ -39,6 +41,11 @@ LEGEND = """subgraph legend{
 }""" % (NODE_COLOR, TRUNK_COLOR, LEAF_COLOR)
 
 
+# State shared with the processes that link calls in parallel. See _find_all_links
+_LINK_STATE = None
+_PARSE_STATE = None
+
+
 LANGUAGES = {
     'py': Python,
     'js': Javascript,
@@ -52,9 +59,10 @@ class LanguageParams():
     """
     Shallow structure to make storing language-specific parameters cleaner
     """
-    def __init__(self, source_type='script', ruby_version='27'):
+    def __init__(self, source_type='script', ruby_version='27', parser_workers=4):
         self.source_type = source_type
         self.ruby_version = ruby_version
+        self.parser_workers = parser_workers
 
 
 class SubsetParams():
@@ -95,6 +103,52 @@ class SubsetParams():
         return SubsetParams(target_function, upstream_depth, downstream_depth)
 
 
+class ResolutionCache():
+    """
+    Memoizes _find_link_for_call. Calls which can see the same variables for
+    their tokens always link to the same place. The variables they see are
+    identified by the innermost scope binding those tokens (see
+    Scope.binding_scope). That is usually a group or file scope shared by
+    many nodes, so e.g. every call to the same module function is resolved once.
+    Attribute calls also depend on the caller's file (see
+    SymbolTable.possible_nodes) so that is part of their key.
+    """
+    def __init__(self):
+        self.links = {}
+        self.hits = 0
+        self.misses = 0
+
+    def find_link_for_call(self, call, node_a, symbol_table, line_number):
+        """
+        Cached version of _find_link_for_call
+        :param call Call:
+        :param node_a Node:
+        :param symbol_table SymbolTable:
+        :param line_number int|None:
+        :rtype: (Node|None, Call|None)
+        """
+        scope, version = node_a.get_scope().binding_scope(call.variable_tokens(), line_number)
+        file_group = node_a.file_group() if call.is_attr() else None
+        key = (scope, version, file_group, call.owner_token, call.token)
+        if key in self.links:
+            self.hits += 1
+            node_b, is_ambiguous = self.links[key]
+            return node_b, call if is_ambiguous else None
+        self.misses += 1
+        node_b, bad_call = _find_link_for_call(call, node_a, symbol_table, line_number)
+        self.links[key] = (node_b, bad_call is not None)
+        return node_b, bad_call
+
+    def log_stats(self):
+        """
+        Log the hit rate
+        :rtype: None
+        """
+        total = self.hits + self.misses
+        if total:
+            logging.info("Resolution cache: %d hits, %d misses (%.1f%% hit rate).",
+                         self.hits, self.misses, 100.0 * self.hits / total)
+
 
 def _find_target_node(subset_params, all_nodes):
     """
@@ -177,19 +231,7 @@ def _filter_groups_for_subset(new_nodes, file_groups):
     :param file_groups list[Group]:
     :rtype: list[Group]
     """
-    for file_group in file_groups:
-        for node in file_group.all_nodes():
-            if node not in new_nodes:
-                node.remove_from_parent()
-
-    new_file_groups = [g for g in file_groups if g.all_nodes()]
-
-    for file_group in new_file_groups:
-        for group in file_group.all_groups():
-            if not group.all_nodes():
-                group.remove_from_parent()
-
-    return new_file_groups
+    return [g for g in file_groups if g.prune(new_nodes)]
 
 
 def _filter_for_subset(subset_params, all_nodes, edges, file_groups):
@@ -208,6 +250,28 @@ def _filter_for_subset(subset_params, all_nodes, edges, file_groups):
     return new_file_groups, list(new_nodes), new_edges
 
 
+def _sort_nodes_and_edges(all_nodes, edges):
+    """
+    Sort nodes by name and edges by the names of the nodes they connect.
+    Names take a walk up the tree to build so we build them once per node
+    and sort on their rank rather than using Node.__lt__ / Edge.__lt__.
+
+    :param all_nodes list[Node]:
+    :param edges list[Edge]:
+    :rtype: None
+    """
+    names = {node: node.name() for node in all_nodes}
+    for edge in edges:
+        for node in (edge.node0, edge.node1):
+            if node not in names:
+                names[node] = node.name()
+    name_ranks = {name: i for i, name in enumerate(sorted(set(names.values())))}
+    sort_keys = {node: name_ranks[name] for node, name in names.items()}
+
+    all_nodes.sort(key=sort_keys.__getitem__)
+    edges.sort(key=lambda edge: (sort_keys[edge.node0], sort_keys[edge.node1]))
+
+
 def generate_json(nodes, edges):
     '''
     Generate a json string from nodes and edges
@@ -363,22 +427,24 @@ def make_file_group(tree, filename, extension):
     return file_group
 
 
-def _find_link_for_call(call, node_a, all_nodes):
+def _find_link_for_call(call, node_a, symbol_table, line_number):
     """
     Given a call that happened on a node (node_a), return the node
     that the call links to and the call itself if >1 node matched.
+    Only variables visible on line_number are considered.
 
     :param call Call:
     :param node_a Node:
-    :param all_nodes list[Node]:
+    :param symbol_table SymbolTable:
+    :param line_number int|None:
 
     :returns: The node it links to and the call if >1 node matched.
     :rtype: (Node|None, Call|None)
     """
 
-    all_vars = node_a.get_variables(call.line_number)
+    variables = node_a.get_scope().lookup(call.variable_tokens(), line_number)
 
-    for var in all_vars:
+    for var in variables:
         var_match = call.matches_variable(var)
         if var_match:
             # Unknown modules (e.g. third party) we don't want to match)
@@ -387,22 +453,7 @@ def _find_link_for_call(call, node_a, all_nodes):
             assert isinstance(var_match, Node)
             return var_match, None
 
-    possible_nodes = []
-    if call.is_attr():
-        for node in all_nodes:
-            # checking node.parent != node_a.file_group() prevents self linkage in cases like
-            # function a() {b = Obj(); b.a()}
-            if call.token == node.token and node.parent != node_a.file_group():
-                possible_nodes.append(node)
-    else:
-        for node in all_nodes:
-            if call.token == node.token \
-               and isinstance(node.parent, Group)  \
-               and node.parent.group_type == GROUP_TYPE.FILE:
-                possible_nodes.append(node)
-            elif call.token == node.parent.token and node.is_constructor:
-                possible_nodes.append(node)
-
+    possible_nodes = symbol_table.possible_nodes(call, node_a)
     if len(possible_nodes) == 1:
         return possible_nodes[0], None
     if len(possible_nodes) > 1:
@@ -410,28 +461,264 @@ def _find_link_for_call(call, node_a, all_nodes):
     return None, None
 
 
-def _find_links(node_a, all_nodes):
+def _find_links(node_a, symbol_table, resolution_cache=None):
     """
     Iterate through the calls on node_a to find everything the node links to.
     This will return a list of tuples of nodes and calls that were ambiguous.
+    A call made on several lines is resolved once for each set of variables
+    those lines can see, which is usually just once.
 
     :param Node node_a:
-    :param list[Node] all_nodes:
-    :param BaseLanguage language:
+    :param SymbolTable symbol_table:
+    :param ResolutionCache|None resolution_cache:
     :rtype: list[(Node, Call)]
     """
 
     links = []
     for call in node_a.calls:
-        lfc = _find_link_for_call(call, node_a, all_nodes)
-        assert not isinstance(lfc, Group)
-        links.append(lfc)
+        call_links = []
+        line_numbers = call.get_line_numbers()
+        if len(line_numbers) > 1:
+            line_numbers = node_a.get_scope().visible_lines(call.variable_tokens(), line_numbers)
+        for line_number in line_numbers:
+            if resolution_cache:
+                lfc = resolution_cache.find_link_for_call(call, node_a, symbol_table,
+                                                          line_number)
+            else:
+                lfc = _find_link_for_call(call, node_a, symbol_table, line_number)
+            assert not isinstance(lfc, Group)
+            if lfc not in call_links:
+                call_links.append(lfc)
+        links += call_links
     return list(filter(None, links))
 
 
+def _usable_jobs(jobs, num_items):
+    """
+    How many processes to actually fork for num_items worth of work.
+    1 means do it in this process.
+
+    :param int jobs:
+    :param int num_items:
+    :rtype: int
+    """
+    jobs = min(jobs, num_items)
+    if jobs > 1 and ('fork' not in multiprocessing.get_all_start_methods()
+                     or sys.platform == 'darwin'):
+        # Forking is unsafe on macOS (it isn't the default start method there)
+        logging.info("Process forking is not available on this platform. "
+                     "Using a single process.")
+        return 1
+    return max(jobs, 1)
+
+
+def _parse_serially(sources, extension, lang_params):
+    """
+    Parse every source and make its file group as soon as its tree arrives.
+    Each tree is dropped once its file group is made so only one is
+    resident at a time.
+
+    :param list[str] sources:
+    :param str extension:
+    :param LanguageParams lang_params:
+    :rtype: iterator[(str, Group|Exception)]
+    """
+    language = LANGUAGES[extension]
+    for source, tree in language.get_trees(sources, lang_params):
+        if isinstance(tree, Exception):
+            yield source, tree
+            continue
+        file_group = make_file_group(tree, source, extension)
+        del tree
+        yield source, file_group
+
+
+def _parse_range(bounds):
+    """
+    Process worker for _parse_all. Processes are forked so the arguments
+    are inherited through _PARSE_STATE. Each process gets its own long-lived
+    parser processes (if the language has any).
+
+    :param (int, int) bounds: start and end index into sources
+    :returns: file summaries, or the exception for files which could not be parsed
+    :rtype: list[(str, FileSummary|Exception)]
+    """
+    sources, extension, lang_params = _PARSE_STATE
+    ret = []
+    for source, file_group in _parse_serially(sources[bounds[0]:bounds[1]], extension,
+                                              lang_params):
+        if isinstance(file_group, Exception):
+            ret.append((source, file_group))
+        else:
+            ret.append((source, FileSummary.from_file_group(file_group)))
+    return ret
+
+
+def _parse_all(sources, extension, lang_params, jobs):
+    """
+    Parse every source and make its file group in forked processes.
+    Sources are split into contiguous ranges and the results are returned
+    in the same order as sources. Processes send back FileSummarys rather
+    than trees or groups to keep what is pickled small.
+    The language's long-lived parser processes are split between the jobs.
+
+    :param list[str] sources:
+    :param str extension:
+    :param LanguageParams lang_params:
+    :param int jobs:
+    :rtype: iterator[(str, Group|Exception)]
+    """
+    global _PARSE_STATE
+
+    chunk_size = -(-len(sources) // (jobs * 4))
+    ranges = [(start, min(start + chunk_size, len(sources)))
+              for start in range(0, len(sources), chunk_size)]
+    job_lang_params = LanguageParams(lang_params.source_type, lang_params.ruby_version,
+                                     -(-lang_params.parser_workers // jobs))
+    _PARSE_STATE = (sources, extension, job_lang_params)
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            for results in pool.imap(_parse_range, ranges):
+                for source, summary in results:
+                    if isinstance(summary, Exception):
+                        yield source, summary
+                    else:
+                        yield source, summary.to_file_group()
+    finally:
+        _PARSE_STATE = None
+
+
+def _raise_or_skip(source, ex, skip_parse_errors):
+    """
+    :param str source:
+    :param Exception ex:
+    :param bool skip_parse_errors:
+    :rtype: None
+    """
+    if skip_parse_errors:
+        logging.warning("Could not parse %r. (%r) Skipping...", source, ex)
+    else:
+        raise ex
+
+
+def _index_linkable_nodes(all_nodes):
+    """
+    Index every node that a call from all_nodes could link to so forked
+    processes can send callees back by index. Besides all_nodes, this is
+    nodes trimmed in step 3 which variables still point to. E.g. Ruby and
+    PHP member variables point straight at nodes.
+
+    :param list[Node] all_nodes:
+    :returns: all_nodes followed by the other linkable nodes + index of each node
+    :rtype: (list[Node], dict[Node, int])
+    """
+    linkable_nodes = list(all_nodes)
+    node_indexes = {node: i for i, node in enumerate(linkable_nodes)}
+
+    def add(nodes):
+        for node in nodes:
+            if isinstance(node, Node) and node not in node_indexes:
+                node_indexes[node] = len(linkable_nodes)
+                linkable_nodes.append(node)
+
+    # Enclosing scopes are shared so only visit each once
+    seen_scopes = set()
+    for node in all_nodes:
+        scope = node.get_scope()
+        while scope is not None and scope not in seen_scopes:
+            seen_scopes.add(scope)
+            for variable in scope.variables:
+                if isinstance(variable.points_to, Node):
+                    add([variable.points_to])
+                elif isinstance(variable.points_to, Group):
+                    add(variable.points_to.all_nodes())
+                    for inherit_nodes in variable.points_to.inherits:
+                        if isinstance(inherit_nodes, list):
+                            add(inherit_nodes)
+            scope = scope.parent
+    return linkable_nodes, node_indexes
+
+
+def _find_links_in_range(bounds):
+    """
+    Process worker for _find_all_links. Processes are forked so the nodes
+    and symbol table are inherited through _LINK_STATE rather than pickled.
+    Results are returned as indexes to keep them small.
+
+    :param (int, int) bounds: start and end index into all_nodes
+    :returns: (caller index, callee index into the linkable nodes, ambiguous call index)
+              tuples + cache hits/misses
+    :rtype: (list[(int, int|None, int|None)], int, int)
+    """
+    linkable_nodes, node_indexes, symbol_table, resolution_cache = _LINK_STATE
+    cache = ResolutionCache() if resolution_cache else None
+    links = []
+    for i in range(*bounds):
+        node_a = linkable_nodes[i]
+        for node_b, bad_call in _find_links(node_a, symbol_table, cache):
+            links.append((i,
+                          node_indexes[node_b] if node_b else None,
+                          node_a.calls.index(bad_call) if bad_call else None))
+    if cache:
+        return links, cache.hits, cache.misses
+    return links, 0, 0
+
+
+def _find_all_links(all_nodes, symbol_table, resolution_cache, jobs):
+    """
+    Find everything every node links to. With jobs > 1, nodes are split into
+    contiguous ranges and linked in forked processes. Results are merged
+    back in order so the output is identical to linking serially.
+
+    :param list[Node] all_nodes:
+    :param SymbolTable symbol_table:
+    :param bool resolution_cache:
+    :param int jobs:
+    :rtype: list[(Node, Node|None, Call|None)]
+    """
+    global _LINK_STATE
+
+    cache = ResolutionCache() if resolution_cache else None
+    jobs = _usable_jobs(jobs, len(all_nodes))
+
+    if jobs <= 1:
+        ret = []
+        for node_a in all_nodes:
+            for node_b, bad_call in _find_links(node_a, symbol_table, cache):
+                ret.append((node_a, node_b, bad_call))
+        if cache:
+            cache.log_stats()
+        return ret
+
+    chunk_size = -(-len(all_nodes) // (jobs * 4))
+    ranges = [(start, min(start + chunk_size, len(all_nodes)))
+              for start in range(0, len(all_nodes), chunk_size)]
+    linkable_nodes, node_indexes = _index_linkable_nodes(all_nodes)
+    _LINK_STATE = (linkable_nodes, node_indexes, symbol_table, resolution_cache)
+    try:
+        with multiprocessing.get_context('fork').Pool(jobs) as pool:
+            results = pool.map(_find_links_in_range, ranges)
+    finally:
+        _LINK_STATE = None
+
+    ret = []
+    for links, hits, misses in results:
+        for i, b, c in links:
+            node_a = all_nodes[i]
+            ret.append((node_a,
+                        linkable_nodes[b] if b is not None else None,
+                        node_a.calls[c] if c is not None else None))
+        if cache:
+            cache.hits += hits
+            cache.misses += misses
+    if cache:
+        cache.log_stats()
+    return ret
+
+
 def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_functions,
            include_only_namespaces, include_only_functions,
-           skip_parse_errors, lang_params):
+           skip_parse_errors, lang_params, resolution_cache=True, jobs=1):
     '''
     Given a language implementation and a list of filenames, do these things:
     1. Read/parse source ASTs
@@ -452,6 +739,8 @@ def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_function
     :param list include_only_functions:
     :param bool skip_parse_errors:
     :param LanguageParams lang_params:
+    :param bool resolution_cache:
+    :param int jobs:
 
     :rtype: (list[Group], list[Node], list[Edge])
     '''
@@ -459,24 +748,21 @@ def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_function
     language = LANGUAGES[extension]
 
     # 0. Assert dependencies
-    language.assert_dependencies()
-
-    # 1. Read/parse source ASTs
-    file_ast_trees = []
-    for source in sources:
-        try:
-            file_ast_trees.append((source, language.get_tree(source, lang_params)))
-        except Exception as ex:
-            if skip_parse_errors:
-                logging.warning("Could not parse %r. (%r) Skipping...", source, ex)
-            else:
-                raise ex
+    language.assert_dependencies(lang_params)
 
-    # 2. Find all groups (classes/modules) and nodes (functions) (a lot happens here)
+    # 1 & 2. Parse sources and find all groups and nodes (a lot happens here).
+    # Each file's tree is released as soon as its file group is made.
+    parse_jobs = _usable_jobs(jobs, len(sources))
+    if parse_jobs > 1:
+        parsed = _parse_all(sources, extension, lang_params, parse_jobs)
+    else:
+        parsed = _parse_serially(sources, extension, lang_params)
     file_groups = []
-    for source, file_ast_tree in file_ast_trees:
-        file_group = make_file_group(file_ast_tree, source, extension)
-        file_groups.append(file_group)
+    for source, file_group in parsed:
+        if isinstance(file_group, Exception):
+            _raise_or_skip(source, file_group, skip_parse_errors)
+        else:
+            file_groups.append(file_group)
 
     # 3. Trim namespaces / functions to exactly what we want
     if exclude_namespaces or include_only_namespaces:
@@ -496,16 +782,17 @@ def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_function
         nodes_by_subgroup_token[subgroup.token] += subgroup.nodes
 
     for group in file_groups:
-        for subgroup in group.all_groups():
+        for subgroup in group.iter_groups():
             subgroup.inherits = [nodes_by_subgroup_token.get(g) for g in subgroup.inherits]
             subgroup.inherits = list(filter(None, subgroup.inherits))
             for inherit_nodes in subgroup.inherits:
-                for node in subgroup.nodes:
-                    node.variables += [Variable(n.token, n, n.line_number) for n in inherit_nodes]
+                subgroup.member_variables += [Variable(n.token, n, n.line_number)
+                                              for n in inherit_nodes]
 
     # 5. Attempt to resolve the variables (point them to a node or group)
+    symbol_table = SymbolTable(file_groups)
     for node in all_nodes:
-        node.resolve_variables(file_groups)
+        node.resolve_variables(symbol_table)
 
     # Not a step. Just log what we know so far
     logging.info("Found groups %r." % [g.label() for g in all_subgroups])
@@ -518,14 +805,13 @@ def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_function
     # 6. Find all calls between all nodes
     bad_calls = []
     edges = []
-    for node_a in list(all_nodes):
-        links = _find_links(node_a, all_nodes)
-        for node_b, bad_call in links:
-            if bad_call:
-                bad_calls.append(bad_call)
-            if not node_b:
-                continue
-            edges.append(Edge(node_a, node_b))
+    for node_a, node_b, bad_call in _find_all_links(all_nodes, symbol_table,
+                                                     resolution_cache, jobs):
+        if bad_call:
+            bad_calls.append(bad_call)
+        if not node_b:
+            continue
+        edges.append(Edge(node_a, node_b))
 
     # 7. Loudly complain about duplicate edges that were skipped
     bad_calls_strings = set()
@@ -545,16 +831,7 @@ def map_it(sources, extension, no_trimming, exclude_namespaces, exclude_function
         nodes_with_edges.add(edge.node0)
         nodes_with_edges.add(edge.node1)
 
-    for node in all_nodes:
-        if node not in nodes_with_edges:
-            node.remove_from_parent()
-
-    for file_group in file_groups:
-        for group in file_group.all_groups():
-            if not group.all_nodes():
-                group.remove_from_parent()
-
-    file_groups = [g for g in file_groups if g.all_nodes()]
+    file_groups = [g for g in file_groups if g.prune(nodes_with_edges)]
     all_nodes = list(nodes_with_edges)
 
     if not all_nodes:
@@ -581,28 +858,27 @@ def _limit_namespaces(file_groups, exclude_namespaces, include_only_namespaces):
     removed_namespaces = set()
 
     for group in list(file_groups):
+        removed_nodes = set()
         if group.token in exclude_namespaces:
-            for node in group.all_nodes():
-                node.remove_from_parent()
+            removed_nodes.update(group.all_nodes())
             removed_namespaces.add(group.token)
         if include_only_namespaces and group.token not in include_only_namespaces:
-            for node in group.nodes:
-                node.remove_from_parent()
+            removed_nodes.update(group.nodes)
             removed_namespaces.add(group.token)
 
         for subgroup in group.all_groups():
-            print(subgroup, subgroup.all_parents())
             if subgroup.token in exclude_namespaces:
-                for node in subgroup.all_nodes():
-                    node.remove_from_parent()
+                removed_nodes.update(subgroup.all_nodes())
                 removed_namespaces.add(subgroup.token)
             if include_only_namespaces and \
                subgroup.token not in include_only_namespaces and \
                all(p.token not in include_only_namespaces for p in subgroup.all_parents()):
-                for node in subgroup.nodes:
-                    node.remove_from_parent()
+                removed_nodes.update(subgroup.nodes)
                 removed_namespaces.add(group.token)
 
+        if removed_nodes:
+            group.prune(set(group.all_nodes()) - removed_nodes, keep_empty_groups=True)
+
     for namespace in exclude_namespaces:
         if namespace not in removed_namespaces:
             logging.warning(f"Could not exclude namespace '{namespace}' "
@@ -623,11 +899,14 @@ def _limit_functions(file_groups, exclude_functions, include_only_functions):
     removed_functions = set()
 
     for group in list(file_groups):
+        keep_nodes = set()
         for node in group.all_nodes():
             if node.token in exclude_functions or \
                (include_only_functions and node.token not in include_only_functions):
-                node.remove_from_parent()
                 removed_functions.add(node.token)
+            else:
+                keep_nodes.add(node)
+        group.prune(keep_nodes, keep_empty_groups=True)
 
     for function_name in exclude_functions:
         if function_name not in removed_functions:
@@ -672,7 +951,8 @@ def code2flow(raw_source_paths, output_file, language=None, hide_legend=True,
               exclude_namespaces=None, exclude_functions=None,
               include_only_namespaces=None, include_only_functions=None,
               no_grouping=False, no_trimming=False, skip_parse_errors=False,
-              lang_params=None, subset_params=None, level=logging.INFO):
+              lang_params=None, subset_params=None, resolution_cache=True,
+              jobs=1, level=logging.INFO):
     """
     Top-level function. Generate a diagram based on source code.
     Can generate either a dotfile or an image.
@@ -690,6 +970,8 @@ def code2flow(raw_source_paths, output_file, language=None, hide_legend=True,
     :param bool skip_parse_errors: If a language parser fails to parse a file, skip it
     :param lang_params LanguageParams: Object to store lang-specific params
     :param subset_params SubsetParams: Object to store subset-specific params
+    :param bool resolution_cache: Memoize call resolution within each function
+    :param int jobs: Number of processes to use
     :param int level: logging level
     :rtype: None
     """
@@ -734,15 +1016,15 @@ def code2flow(raw_source_paths, output_file, language=None, hide_legend=True,
     file_groups, all_nodes, edges = map_it(sources, language, no_trimming,
                                            exclude_namespaces, exclude_functions,
                                            include_only_namespaces, include_only_functions,
-                                           skip_parse_errors, lang_params)
+                                           skip_parse_errors, lang_params, resolution_cache,
+                                           jobs)
 
     if subset_params:
         logging.info("Filtering into subset...")
         file_groups, all_nodes, edges = _filter_for_subset(subset_params, all_nodes, edges, file_groups)
 
     file_groups.sort()
-    all_nodes.sort()
-    edges.sort()
+    _sort_nodes_and_edges(all_nodes, edges)
 
     logging.info("Generating output file...")
 
@@ -822,13 +1104,26 @@ def main(sys_argv=None):
     parser.add_argument(
         '--skip-parse-errors', action='store_true',
         help='skip files that the language parser fails on.')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=os.cpu_count() or 1,
+        help='number of processes to use when parsing files and finding calls '
+             'between functions. Defaults to the number of CPUs. Requires '
+             'process forking (not used on macOS or Windows).')
+    parser.add_argument(
+        '--no-resolution-cache', action='store_true',
+        help='resolve every call from scratch instead of memoizing repeated calls.')
     parser.add_argument(
         '--source-type', choices=['script', 'module'], default='script',
         help='js only. Parse the source as scripts (commonJS) or modules (es6)')
     parser.add_argument(
         '--ruby-version', default='27',
-        help='ruby only. Which ruby version to parse? This is passed directly into ruby-parse. '
+        help='ruby only. Which ruby version to parse? This selects the parser gem\'s grammar. '
              'Use numbers like 25, 27, or 31.')
+    parser.add_argument(
+        '--parser-workers', type=int, default=4,
+        help='js, ruby, and php only. How many files long-lived parser processes work '
+             'on at once. Use 0 to start a new parser process for every file instead, '
+             'running as many at once as there are CPUs.')
     parser.add_argument(
         '--quiet', '-q', action='store_true',
         help='suppress most logging')
@@ -853,7 +1148,7 @@ def main(sys_argv=None):
     include_only_namespaces = list(filter(None, (args.include_only_namespaces or "").split(',')))
     include_only_functions = list(filter(None, (args.include_only_functions or "").split(',')))
 
-    lang_params = LanguageParams(args.source_type, args.ruby_version)
+    lang_params = LanguageParams(args.source_type, args.ruby_version, args.parser_workers)
     subset_params = SubsetParams.generate(args.target_function, args.upstream_depth,
                                           args.downstream_depth)
 
@@ -871,5 +1166,7 @@ def main(sys_argv=None):
         skip_parse_errors=args.skip_parse_errors,
         lang_params=lang_params,
         subset_params=subset_params,
+        resolution_cache=not args.no_resolution_cache,
+        jobs=args.jobs,
         level=level,
     )
@@ -1,9 +1,427 @@
 const fs = require('fs');
-const {Parser} = require("acorn")
+const readline = require('readline');
+const {Worker, isMainThread, parentPort} = require('worker_threads');
+const acorn = require("acorn")
 
-const sourceType = process.argv[2]
-const src = fs.readFileSync(process.argv[3], 'utf8')
-const tree = Parser.parse(src, {'locations': true, 'sourceType': sourceType,
-                                'ecmaVersion': '2020'})
+function parse(sourceType, filename) {
+    const src = fs.readFileSync(filename, 'utf8')
+    return acorn.Parser.parse(src, {'locations': true, 'sourceType': sourceType,
+                                    'ecmaVersion': '2020'})
+}
 
-process.stdout.write(JSON.stringify(tree))
+// IR mode. Instead of the entire AST, send only what javascript.py uses:
+// classes and functions with their nesting and, for every scope, its calls
+// and variables. This mirrors the tree walking in javascript.py exactly.
+// Where javascript.py would fail on the full AST, fail the file instead.
+
+const UNKNOWN_VAR = 'UNKNOWN_VAR'
+
+function line(el) {
+    return el.loc.start.line
+}
+
+// Code that acorn parses but javascript.py can't handle. These are reported
+// as unsupported rather than as parse errors
+class UnsupportedError extends Error {}
+
+function unsupported(el, what) {
+    return new UnsupportedError('Unsupported ' + what + ' on line ' + line(el))
+}
+
+function isNode(v) {
+    return v !== null && typeof v === 'object' && !Array.isArray(v) && Boolean(v.type)
+}
+
+function extend(arr, items) {
+    for (const item of items) {
+        arr.push(item)
+    }
+}
+
+// The nodes directly below tree, in the order walk visits them
+function* typedChildren(tree) {
+    if (Array.isArray(tree)) {
+        for (const el of tree) {
+            if (el === null) {
+                throw new UnsupportedError('Unsupported empty array element')
+            }
+            if (el.type) {
+                yield el
+            }
+        }
+        return
+    }
+    for (const key of Object.keys(tree)) {
+        const v = tree[key]
+        if (isNode(v)) {
+            yield v
+        }
+        if (Array.isArray(v)) {
+            yield* typedChildren(v)
+        }
+    }
+}
+
+// Pre-order, same as javascript.walk. Uses an explicit stack so deeply
+// nested code can't overflow the call stack.
+function walk(tree, visit) {
+    const stack = [typedChildren(tree)]
+    while (stack.length) {
+        const next = stack[stack.length - 1].next()
+        if (next.done) {
+            stack.pop()
+            continue
+        }
+        visit(next.value)
+        stack.push(typedChildren(next.value))
+    }
+}
+
+function children(tree) {
+    const ret = []
+    for (const key of Object.keys(tree)) {
+        const v = tree[key]
+        if (isNode(v)) {
+            ret.push(v)
+        }
+        if (Array.isArray(v)) {
+            extend(ret, v.filter(Boolean))
+        }
+    }
+    return ret
+}
+
+// Same as javascript.Javascript.separate_namespaces. Each frame is an element,
+// its children, and its groups, nodes, and body. When an element is finished,
+// its results are merged into its parent's if it contained groups or nodes.
+// Otherwise, it is part of the body.
+function separateNamespaces(tree) {
+    const stack = [{'el': tree, 'children': children(tree), 'next': 0,
+                    'groups': [], 'nodes': [], 'body': []}]
+    while (true) {
+        const frame = stack[stack.length - 1]
+        if (frame.next === frame.children.length) {
+            stack.pop()
+            if (!stack.length) {
+                return [frame.groups, frame.nodes, frame.body]
+            }
+            const parent = stack[stack.length - 1]
+            if (frame.groups.length || frame.nodes.length) {
+                extend(parent.groups, frame.groups)
+                extend(parent.nodes, frame.nodes)
+                extend(parent.body, frame.body)
+            } else {
+                parent.body.push(frame.el)
+            }
+            continue
+        }
+        const el = frame.children[frame.next++]
+        if (el.type === 'MethodDefinition' || el.type === 'FunctionDeclaration') {
+            frame.nodes.push(el)
+        } else if (el.type === 'ClassDeclaration') {
+            frame.groups.push(el)
+        } else {
+            stack.push({'el': el, 'children': children(el), 'next': 0,
+                        'groups': [], 'nodes': [], 'body': []})
+        }
+    }
+}
+
+function resolveOwner(callee) {
+    const owner = callee.object
+    if (owner.type === 'ThisExpression') {
+        return 'this'
+    }
+    if (owner.type === 'Identifier') {
+        return owner.name
+    }
+    if (owner.type === 'MemberExpression') {
+        if ('name' in owner.property) {
+            return (resolveOwner(owner) || '') + '.' + owner.property.name
+        }
+        return UNKNOWN_VAR
+    }
+    if (owner.type === 'CallExpression') {
+        return UNKNOWN_VAR
+    }
+    if (owner.type === 'NewExpression') {
+        const cls = owner.callee
+        if ('name' in cls) {
+            return cls.name
+        }
+        if (cls.object && 'name' in cls.object && 'name' in cls.property) {
+            return cls.object.name + '.' + cls.property.name
+        }
+        throw unsupported(owner, 'constructor')
+    }
+    return UNKNOWN_VAR
+}
+
+// Calls are [token, line, owner token or null]
+function callFromFuncElement(func) {
+    const callee = func.callee
+    if (callee.type === 'MemberExpression' && 'name' in callee.property) {
+        return [callee.property.name, line(callee), resolveOwner(callee)]
+    }
+    if (callee.type === 'Identifier') {
+        return [callee.name, line(callee), null]
+    }
+    return null
+}
+
+function makeCalls(body) {
+    const calls = []
+    walk(body, (el) => {
+        if (el.type === 'CallExpression') {
+            const call = callFromFuncElement(el)
+            if (call) {
+                calls.push(call)
+            }
+        } else if (el.type === 'NewExpression' && el.callee.type === 'Identifier') {
+            calls.push([el.callee.name, line(el), null])
+        }
+    })
+    return calls
+}
+
+function importPath(element, src, name) {
+    if (typeof src !== 'string') {
+        throw unsupported(element, 'import')
+    }
+    return src + '.' + name
+}
+
+// Variables are [token, line, import path string or call]
+function processAssign(element) {
+    if (element.declarations.length > 1) {
+        return []
+    }
+    const target = element.declarations[0]
+    const init = target.init
+    const id = target.id
+    const lineNumber = line(element)
+    if (init === null) {
+        return []
+    }
+
+    if (init.type === 'NewExpression') {
+        if (!('name' in id)) {
+            throw unsupported(element, 'assignment')
+        }
+        const call = callFromFuncElement(init)
+        if (call) {
+            return [[id.name, lineNumber, call]]
+        }
+    }
+
+    if (init.type === 'CallExpression' && init.callee.name === 'require') {
+        const arg = init.arguments[0]
+        if (!arg || !('value' in arg)) {
+            throw unsupported(element, 'require')
+        }
+        if ('name' in id) {
+            return [[id.name, lineNumber, importPath(element, arg.value, id.name)]]
+        }
+        const ret = []
+        for (const prop of id.properties || []) {
+            if (!prop.key || !('name' in prop.key)) {
+                throw unsupported(element, 'require')
+            }
+            ret.push([prop.key.name, lineNumber, importPath(element, arg.value, prop.key.name)])
+        }
+        return ret
+    }
+
+    if (init.type === 'ImportExpression') {
+        if (!('raw' in init.source) || !('name' in id)) {
+            throw unsupported(element, 'import')
+        }
+        return [[id.name, lineNumber, init.source.raw + '.' + id.name]]
+    }
+
+    if (init.type === 'CallExpression') {
+        if (!('name' in id)) {
+            return []
+        }
+        const call = callFromFuncElement(init)
+        if (call) {
+            return [[id.name, lineNumber, call]]
+        }
+    }
+    return []
+}
+
+// The calls and variables of a scope. 'line' is where a 'this' variable
+// would be defined, or null if the scope is empty.
+function makeBody(body) {
+    const variables = []
+    walk(body, (el) => {
+        if (el.type === 'VariableDeclaration') {
+            extend(variables, processAssign(el))
+        }
+    })
+    return {'type': 'BodyIR', 'calls': makeCalls(body), 'variables': variables,
+            'line': body.length ? line(body[0]) : null}
+}
+
+function makeFunction(tree) {
+    let token
+    let isConstructor = false
+    if (tree.kind === 'constructor') {
+        token = '(constructor)'
+        isConstructor = true
+    } else if (tree.type === 'FunctionDeclaration') {
+        if (!tree.id) {
+            throw unsupported(tree, 'anonymous function declaration')
+        }
+        token = tree.id.name
+    } else {
+        if (!('name' in tree.key)) {
+            throw unsupported(tree, 'method name')
+        }
+        token = tree.key.name
+    }
+    const fullBody = tree.type === 'FunctionDeclaration' ? tree.body : tree.value
+    const [groups, nodes, body] = separateNamespaces(fullBody)
+    return {'type': 'FunctionIR', 'token': token, 'is_constructor': isConstructor,
+            'line': line(tree), 'nested_classes': groups.length > 0,
+            'body': makeBody(body), 'nodes': nodes.map(makeFunction)}
+}
+
+function getInherits(tree) {
+    const sup = tree.superClass
+    if (!sup) {
+        return []
+    }
+    if ('name' in sup) {
+        return [sup.name]
+    }
+    if (sup.object && 'name' in sup.object && sup.property && 'name' in sup.property) {
+        return [sup.object.name + '.' + sup.property.name]
+    }
+    throw unsupported(tree, 'superclass')
+}
+
+function makeClass(tree) {
+    const [groups, nodes] = separateNamespaces(tree)
+    if (groups.length) {
+        throw unsupported(tree, 'nested class')
+    }
+    if (!tree.id) {
+        throw unsupported(tree, 'anonymous class declaration')
+    }
+    return {'type': 'ClassIR', 'token': tree.id.name, 'line': line(tree),
+            'inherits': getInherits(tree), 'nodes': nodes.map(makeFunction)}
+}
+
+function makeIR(tree) {
+    const [groups, nodes, body] = separateNamespaces(tree)
+    return {'type': 'ProgramIR', 'groups': groups.map(makeClass),
+            'nodes': nodes.map(makeFunction), 'body': makeBody(body)}
+}
+
+// Serialize the response to a single request. Errors are reported per file
+// instead of killing the worker. Their kind is 'unsupported' or 'parse'.
+function handle(request) {
+    try {
+        const tree = parse(request.source_type, request.file)
+        return JSON.stringify({'id': request.id, 'tree': request.ir ? makeIR(tree) : tree})
+    } catch (e) {
+        return JSON.stringify({'id': request.id, 'error': String(e.message || e),
+                               'kind': e instanceof UnsupportedError ? 'unsupported' : 'parse'})
+    }
+}
+
+// Every response is a JSON document prefixed by its 4-byte big-endian length
+function writeFrame(json) {
+    const body = Buffer.from(json, 'utf8')
+    const header = Buffer.alloc(4)
+    header.writeUInt32BE(body.length)
+    process.stdout.write(Buffer.concat([header, body]))
+}
+
+// Long-lived mode. Read one JSON request per line from stdin and stream back
+// one frame per request. Requests are parsed on up to maxThreads threads which
+// are only started once there are enough requests in flight to need them.
+function serve(maxThreads) {
+    writeFrame(JSON.stringify({'version': acorn.version}))
+
+    const queue = []
+    const idle = []
+    const busy = new Map()
+    let nThreads = 0
+    let closed = false
+
+    function finish() {
+        if (closed && !queue.length && !busy.size) {
+            for (const thread of idle) {
+                thread.terminate()
+            }
+        }
+    }
+
+    function startThread() {
+        const thread = new Worker(__filename)
+        nThreads++
+        thread.on('message', (json) => {
+            busy.delete(thread)
+            idle.push(thread)
+            writeFrame(json)
+            dispatch()
+        })
+        thread.on('error', (e) => {
+            const request = busy.get(thread)
+            busy.delete(thread)
+            if (idle.includes(thread)) {
+                idle.splice(idle.indexOf(thread), 1)
+            }
+            nThreads--
+            if (request) {
+                writeFrame(JSON.stringify({'id': request.id, 'error': String(e.message || e)}))
+            }
+            dispatch()
+        })
+        return thread
+    }
+
+    function dispatch() {
+        while (queue.length) {
+            if (maxThreads <= 1) {
+                writeFrame(handle(queue.shift()))
+                continue
+            }
+            if (!idle.length && nThreads < maxThreads) {
+                idle.push(startThread())
+            }
+            const thread = idle.pop()
+            if (!thread) {
+                break
+            }
+            const request = queue.shift()
+            busy.set(thread, request)
+            thread.postMessage(request)
+        }
+        finish()
+    }
+
+    const rl = readline.createInterface({'input': process.stdin})
+    rl.on('line', (line) => {
+        if (line.trim()) {
+            queue.push(JSON.parse(line))
+            dispatch()
+        }
+    })
+    rl.on('close', () => {
+        closed = true
+        finish()
+    })
+}
+
+if (!isMainThread) {
+    parentPort.on('message', (request) => parentPort.postMessage(handle(request)))
+} else if (process.argv[2] === '--serve') {
+    serve(parseInt(process.argv[3] || '1', 10))
+} else {
+    const tree = parse(process.argv[2], process.argv[3])
+    process.stdout.write(JSON.stringify(tree))
+}
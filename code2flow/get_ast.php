@@ -2,15 +2,147 @@
 require_once __DIR__ . '/vendor/autoload.php';
 
 use PhpParser\Error;
+use PhpParser\Node;
 use PhpParser\NodeDumper;
+use PhpParser\NodeTraverser;
+use PhpParser\NodeVisitorAbstract;
 use PhpParser\ParserFactory;
 
-$code = file_get_contents($argv[1]);
+// Shrink the tree down to what php.py uses while keeping php-parser's shape:
+//  - Attributes are reduced to startLine. This drops comments and positions.
+//  - String contents are blanked.
+//  - Arguments, array items, and parameters which contain nothing that php.py
+//    looks for (calls, assignments, uses, functions, classes...) are stubbed out.
+//    They are stubbed rather than removed because the first line of a body matters.
+//    The stub is an empty string which every php-parser version has.
+class Reducer extends NodeVisitorAbstract {
+    const RELEVANT = array(
+        'Expr_FuncCall', 'Expr_New', 'Expr_MethodCall', 'Expr_StaticCall',
+        'Expr_BinaryOp_Concat', 'Expr_Assign', 'Stmt_Use', 'Stmt_Function',
+        'Stmt_ClassMethod', 'Expr_Closure', 'Stmt_Class', 'Stmt_Namespace',
+        'Stmt_Trait');
+
+    private $relevant;
+
+    public function beforeTraverse(array $nodes) {
+        $this->relevant = new SplObjectStorage();
+    }
+
+    private function isRelevant(Node $node) {
+        if (in_array($node->getType(), self::RELEVANT)) {
+            return true;
+        }
+        foreach ($node->getSubNodeNames() as $name) {
+            $subnodes = is_array($node->$name) ? $node->$name : array($node->$name);
+            foreach ($subnodes as $subnode) {
+                if ($subnode instanceof Node && $this->relevant->contains($subnode)) {
+                    return true;
+                }
+            }
+        }
+        return false;
+    }
+
+    public function leaveNode(Node $node) {
+        $attributes = array('startLine' => $node->getStartLine());
+        $node->setAttributes($attributes);
+        if ($this->isRelevant($node)) {
+            $this->relevant->attach($node);
+            return null;
+        }
+
+        if ($node instanceof Node\Scalar\String_
+            || $node instanceof Node\Scalar\EncapsedStringPart
+            || $node instanceof Node\Stmt\InlineHTML) {
+            $node->value = '';
+        } elseif ($node instanceof Node\Arg) {
+            $node->value = new Node\Scalar\String_('', $attributes);
+        } elseif ($node instanceof Node\Expr\ArrayItem) {
+            $node->key = null;
+            $node->value = new Node\Scalar\String_('', $attributes);
+        } elseif ($node instanceof Node\Param) {
+            $node->type = null;
+            $node->default = null;
+            $node->attrGroups = array();
+        }
+        return null;
+    }
+}
+
+const JSON_FLAGS = JSON_UNESCAPED_SLASHES | JSON_UNESCAPED_UNICODE;
+
+// php.py only understands php-parser 4's tree so it checks this first
+function versions() {
+    if (class_exists('Composer\InstalledVersions')) {
+        $parser_version = Composer\InstalledVersions::getPrettyVersion('nikic/php-parser');
+    } else {
+        // PhpVersion was added in php-parser 5
+        $parser_version = class_exists('PhpParser\PhpVersion') ? '5' : '4';
+    }
+    return array('version' => PHP_VERSION, 'parser_version' => $parser_version);
+}
+
+function parse($parser, $traverser, $code) {
+    return $traverser->traverse($parser->parse($code));
+}
+
+// Every response is a JSON document prefixed by its 4-byte big-endian length
+function write_frame($response) {
+    $json = json_encode($response, JSON_FLAGS);
+    if ($json === false) {
+        $json = json_encode(array('id' => $response['id'],
+                                  'error' => 'Could not encode AST: ' . json_last_error_msg()));
+    }
+    fwrite(STDOUT, pack('N', strlen($json)) . $json);
+    fflush(STDOUT);
+}
+
+// Long-lived mode. Read one JSON request per line from stdin and write back
+// one frame per request. Parse errors are reported per file.
+function serve($parser, $traverser) {
+    while (($line = fgets(STDIN)) !== false) {
+        if (trim($line) === '') {
+            continue;
+        }
+        $request = json_decode($line, true);
+        $response = array('id' => $request['id']);
+        try {
+            $code = @file_get_contents($request['file']);
+            if ($code === false) {
+                throw new Exception('Could not read ' . $request['file']);
+            }
+            $response['tree'] = parse($parser, $traverser, $code);
+        } catch (Throwable $e) {
+            $response['error'] = $e->getMessage();
+        }
+        write_frame($response);
+    }
+}
+
+if ($argv[1] === '--version') {
+    echo json_encode(versions(), JSON_FLAGS), "\n";
+    exit(0);
+}
+
+if ($argv[1] === '--serve') {
+    // The handshake goes first so that an unsupported php-parser is reported
+    write_frame(versions());
+}
+
 $parser = (new ParserFactory)->create(ParserFactory::PREFER_PHP7);
+$traverser = new NodeTraverser();
+$traverser->addVisitor(new Reducer());
+
+if ($argv[1] === '--serve') {
+    serve($parser, $traverser);
+    exit(0);
+}
+
+$code = file_get_contents($argv[1]);
 
 try {
-    $stmts = $parser->parse($code);
-    echo json_encode($stmts, JSON_PRETTY_PRINT), "\n";
+    $stmts = parse($parser, $traverser, $code);
+    echo json_encode($stmts, JSON_FLAGS), "\n";
 } catch (PhpParser\Error $e) {
     echo 'Parse Error: ', $e->getMessage();
     exit(1);
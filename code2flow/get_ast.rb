@@ -0,0 +1,61 @@
+# Print the AST of a ruby file as JSON. Equivalent to `ruby-parse --emit-json`
+#   ruby get_ast.rb 27 file.rb
+# Or, as a long-lived worker, read one JSON request per line from stdin and
+# write back one length-prefixed JSON frame per request
+#   ruby get_ast.rb --serve
+require 'json'
+require 'parser'
+
+# Same AST format as ruby-parse which uses the modern node types by default
+if Parser::Builders::Default.respond_to?(:modernize)
+  Parser::Builders::Default.modernize
+end
+
+def parser_class(ruby_version)
+  require "parser/ruby#{ruby_version}"
+  Parser.const_get("Ruby#{ruby_version}")
+end
+
+def parse(filename, ruby_version)
+  parser = parser_class(ruby_version).new
+  parser.diagnostics.all_errors_are_fatal = true
+  parser.diagnostics.ignore_warnings = true
+  buffer = Parser::Source::Buffer.new(filename)
+  buffer.read
+  ast = parser.parse(buffer)
+  ast && ast.to_sexp_array
+end
+
+# Every response is a JSON document prefixed by its 4-byte big-endian length
+def write_frame(json)
+  $stdout.write([json.bytesize].pack('N'), json)
+  $stdout.flush
+end
+
+# A syntax error in one file is reported for that file and the worker moves on
+def serve
+  $stdout.binmode
+  write_frame(JSON.generate('version' => Parser::VERSION))
+  $stdin.each_line do |line|
+    next if line.strip.empty?
+    request = JSON.parse(line)
+    begin
+      tree = parse(request['file'], request['ruby_version'])
+      json = JSON.generate('id' => request['id'], 'tree' => tree)
+    rescue StandardError, ScriptError => e
+      json = JSON.generate('id' => request['id'], 'error' => e.message.to_s.scrub)
+    end
+    write_frame(json)
+  end
+end
+
+if ARGV[0] == '--serve'
+  serve
+else
+  begin
+    puts JSON.generate(parse(ARGV[1], ARGV[0]))
+  rescue StandardError, ScriptError => e
+    warn e.message
+    exit 1
+  end
+end
@@ -1,10 +1,16 @@
 import logging
 import os
-import json
 import subprocess
 
-from .model import (Group, Node, Call, Variable, BaseLanguage,
-                    OWNER_CONST, GROUP_TYPE, is_installed, djoin, flatten)
+from .model import (Group, Node, Call, Variable, OWNER_CONST, GROUP_TYPE,
+                    is_installed, djoin, flatten)
+from .parsers import ParserPool, ParserCrashedError, PooledLanguage
+
+SCRIPT_LOC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "get_ast.js")
+
+# Node threads are started lazily so this is only a ceiling. How many files are
+# parsed at once is decided by LanguageParams.parser_workers
+MAX_WORKER_THREADS = os.cpu_count() or 1
 
 
 def lineno(el):
@@ -21,26 +27,44 @@ def lineno(el):
     return ret
 
 
-def walk(tree):
+def typed_children(tree):
     """
-    Walk through the ast tree and return all nodes
-    :param ast tree:
-    :rtype: list[ast]
+    Iterate through the direct children of an element (or list of elements)
+    that are themselves ast elements. This is the order that walk visits them.
+    :param list|dict tree:
+    :rtype: iterator[ast]
     """
-    ret = []
     if type(tree) == list:
         for el in tree:
             if el.get('type'):
-                ret.append(el)
-                ret += walk(el)
+                yield el
     elif type(tree) == dict:
-        for k, v in tree.items():
+        for v in tree.values():
             if type(v) == dict and v.get('type'):
-                ret.append(v)
-                ret += walk(v)
+                yield v
             if type(v) == list:
-                ret += walk(v)
-    return ret
+                for el in v:
+                    if el.get('type'):
+                        yield el
+
+
+def walk(tree, types=None):
+    """
+    Walk through the ast tree and yield all nodes in pre-order.
+    Uses an explicit stack so deeply nested code can't hit the recursion limit.
+    :param list|dict tree:
+    :param tuple[str]|None types: If given, only yield nodes of these types
+    :rtype: iterator[ast]
+    """
+    stack = [typed_children(tree)]
+    while stack:
+        el = next(stack[-1], None)
+        if el is None:
+            stack.pop()
+            continue
+        if types is None or el['type'] in types:
+            yield el
+        stack.append(typed_children(el))
 
 
 def resolve_owner(callee):
@@ -102,7 +126,7 @@ def make_calls(body):
     :rtype: list[Call]
     """
     calls = []
-    for element in walk(body):
+    for element in walk(body, ('CallExpression', 'NewExpression')):
         if element['type'] == 'CallExpression':
             call = get_call_from_func_element(element)
             if call:
@@ -188,9 +212,8 @@ def make_local_variables(tree, parent):
         return []
 
     variables = []
-    for element in walk(tree):
-        if element['type'] == 'VariableDeclaration':
-            variables += process_assign(element)
+    for element in walk(tree, ('VariableDeclaration',)):
+        variables += process_assign(element)
 
     # Make a 'this' variable for use anywhere we need it that points to the class
     if isinstance(parent, Group) and parent.group_type == GROUP_TYPE.CLASS:
@@ -202,18 +225,16 @@ def make_local_variables(tree, parent):
 
 def children(tree):
     """
-    The acorn AST is tricky. This returns all the children of an element
+    The acorn AST is tricky. This iterates through all the children of an element
     :param ast tree:
-    :rtype: list[ast]
+    :rtype: iterator[ast]
     """
     assert type(tree) == dict
-    ret = []
-    for k, v in tree.items():
+    for v in tree.values():
         if type(v) == dict and v.get('type'):
-            ret.append(v)
+            yield v
         if type(v) == list:
-            ret += filter(None, v)
-    return ret
+            yield from filter(None, v)
 
 
 def get_inherits(tree):
@@ -229,28 +250,89 @@ def get_inherits(tree):
     return []
 
 
-def get_acorn_version():
+def calls_from_ir(body):
     """
-    Get the version of installed acorn
-    :rtype: str
+    Make Calls from the compact IR that get_ast.js emits in place of the AST.
+    Each IR call is [token, line_number, owner_token|None].
+
+    :param body dict: A BodyIR
+    :rtype: list[Call]
     """
-    proc = subprocess.Popen(['node', '-p', 'require(\'acorn/package.json\').version'],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            cwd=os.path.dirname(os.path.realpath(__file__)))
-    assert proc.wait() == 0, "Acorn is required to parse javascript files. " \
-                             "It was found on the path but could not be imported " \
-                             "in node.\n" + proc.stderr.read().decode()
-    return proc.stdout.read().decode().strip()
+    return [Call(token=token, line_number=line_number, owner_token=owner_token)
+            for token, line_number, owner_token in body['calls']]
 
 
-class Javascript(BaseLanguage):
+def variables_from_ir(body, parent):
+    """
+    Make Variables from the compact IR. Each IR variable is
+    [token, line_number, points_to] where points_to is either an import
+    string or a call in the same format as calls_from_ir.
+    Like make_local_variables, add 'this' if the parent is a class.
+
+    :param body dict: A BodyIR
+    :param parent Group:
+    :rtype: list[Variable]
+    """
+    variables = []
+    for token, line_number, points_to in body['variables']:
+        if isinstance(points_to, list):
+            points_to = Call(token=points_to[0], line_number=points_to[1],
+                             owner_token=points_to[2])
+        variables.append(Variable(token, points_to, line_number))
+
+    if body['line'] is not None and isinstance(parent, Group) \
+       and parent.group_type == GROUP_TYPE.CLASS:
+        variables.append(Variable('this', parent, body['line']))
+    return variables
+
+
+def get_acorn_pool():
+    """
+    Get the long-lived node process which parses files with acorn
+    :rtype: ParserPool
+    """
+    return ParserPool.for_current_process(
+        ["node", SCRIPT_LOC, "--serve", str(MAX_WORKER_THREADS)])
+
+
+def get_acorn_version(lang_params):
+    """
+    Get the version of installed acorn. If we are going to parse with the
+    node worker, this is from its handshake. Otherwise, ask node once.
+
+    :param lang_params LanguageParams:
+    :rtype: str
+    """
+    assert_msg = "Acorn is required to parse javascript files. " \
+                 "It was found on the path but could not be imported in node.\n"
+    if not lang_params.parser_workers:
+        proc = subprocess.run(['node', '-p', 'require(\'acorn/package.json\').version'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              cwd=os.path.dirname(os.path.realpath(__file__)))
+        assert not proc.returncode, assert_msg + proc.stderr.decode(errors='replace')
+        return proc.stdout.decode().strip()
+    try:
+        return get_acorn_pool().handshake()['version']
+    except ParserCrashedError as ex:
+        raise AssertionError(assert_msg + str(ex)) from None
+
+
+class Javascript(PooledLanguage):
+    # node parses on up to parser_workers threads of its own
+    PROCESS_PER_WORKER = False
+
     @staticmethod
-    def assert_dependencies():
-        """Assert that acorn is installed and the correct version"""
+    def assert_dependencies(lang_params):
+        """
+        Assert that acorn is installed and the correct version. The node
+        worker is only started if we are going to parse with it.
+
+        :param lang_params LanguageParams:
+        """
         assert is_installed('acorn'), "Acorn is required to parse javascript files " \
                                       "but was not found on the path. Install it " \
                                       "from npm and try again."
-        version = get_acorn_version()
+        version = get_acorn_version(lang_params)
         if not version.startswith('8.'):
             logging.warning("Acorn is required to parse javascript files. "
                             "Version %r was found but code2flow has only been "
@@ -258,31 +340,77 @@ class Javascript(BaseLanguage):
         logging.info("Using Acorn %s" % version)
 
     @staticmethod
-    def get_tree(filename, lang_params):
+    def get_pool():
+        """
+        :rtype: ParserPool
         """
-        Get the entire AST for this file
+        return get_acorn_pool()
+
+    @staticmethod
+    def get_tree_cmd(filename, lang_params):
+        """
+        The command to parse a single file with its own node process.
+        This prints the entire AST.
 
         :param filename str:
         :param lang_params LanguageParams:
+        :rtype: list[str]
+        """
+        return ["node", SCRIPT_LOC, lang_params.source_type, filename]
+
+    @staticmethod
+    def make_request(filename, lang_params):
+        """
+        The node worker sends back the compact IR rather than the entire AST
+
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: dict
+        """
+        return {'file': os.path.abspath(filename),
+                'source_type': lang_params.source_type,
+                'ir': True}
+
+    @staticmethod
+    def parse_error(filename):
+        """
+        :param filename str:
+        :rtype: AssertionError
+        """
+        return AssertionError(
+            "Acorn could not parse file %r. You may have a JS syntax error or "
+            "if this is an es6-style source, you may need to run code2flow "
+            "with --source-type=module. "
+            "For more detail, try running the command "
+            "\n  acorn %s\n"
+            "Warning: Acorn CANNOT parse all javascript files. See their docs. " %
+            (filename, filename))
+
+    @classmethod
+    def tree_from_response(cls, filename, response):
+        """
+        The node worker fails files which acorn parsed but which use something
+        we can't handle. That isn't a syntax error so don't say it is.
+
+        :param filename str:
+        :param response dict:
         :rtype: ast
         """
-        script_loc = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                  "get_ast.js")
-        cmd = ["node", script_loc, lang_params.source_type, filename]
-        try:
-            output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError:
+        if response.get('kind') == 'unsupported':
             raise AssertionError(
-                "Acorn could not parse file %r. You may have a JS syntax error or "
-                "if this is an es6-style source, you may need to run code2flow "
-                "with --source-type=module. "
-                "For more detail, try running the command "
-                "\n  acorn %s\n"
-                "Warning: Acorn CANNOT parse all javascript files. See their docs. " %
-                (filename, filename)) from None
-        tree = json.loads(output)
+                "Acorn parsed file %r but code2flow does not support what it found: "
+                "%s. To skip files like this, run code2flow with --skip-parse-errors. " %
+                (filename, response['error']))
+        return super().tree_from_response(filename, response)
+
+    @staticmethod
+    def check_tree(tree):
+        """
+        :param tree ast:
+        :rtype: ast
+        """
         assert isinstance(tree, dict)
-        assert tree['type'] == 'Program'
+        assert tree['type'] in ('Program', 'ProgramIR')
         return tree
 
     @staticmethod
@@ -298,23 +426,33 @@ class Javascript(BaseLanguage):
         :rtype: (list[ast], list[ast], list[ast])
         """
 
-        groups = []
-        nodes = []
-        body = []
-        for el in children(tree):
-            if el['type'] in ('MethodDefinition', 'FunctionDeclaration'):
-                nodes.append(el)
-            elif el['type'] == 'ClassDeclaration':
-                groups.append(el)
-            else:
-                tup = Javascript.separate_namespaces(el)
-                if tup[0] or tup[1]:
-                    groups += tup[0]
-                    nodes += tup[1]
-                    body += tup[2]
+        if tree['type'] == 'ProgramIR':
+            return tree['groups'], tree['nodes'], tree['body']
+
+        # Each frame is (element, its remaining children, groups, nodes, body).
+        # When an element is finished, its results are merged into its parent's
+        # if it contained groups or nodes. Otherwise, it is part of the body.
+        stack = [(tree, children(tree), [], [], [])]
+        while True:
+            el, remaining, groups, nodes, body = stack[-1]
+            child = next(remaining, None)
+            if child is None:
+                stack.pop()
+                if not stack:
+                    return groups, nodes, body
+                parent_groups, parent_nodes, parent_body = stack[-1][2:]
+                if groups or nodes:
+                    parent_groups += groups
+                    parent_nodes += nodes
+                    parent_body += body
                 else:
-                    body.append(el)
-        return groups, nodes, body
+                    parent_body.append(el)
+            elif child['type'] in ('MethodDefinition', 'FunctionDeclaration'):
+                nodes.append(child)
+            elif child['type'] == 'ClassDeclaration':
+                groups.append(child)
+            else:
+                stack.append((child, children(child), [], [], []))
 
     @staticmethod
     def make_nodes(tree, parent):
@@ -327,6 +465,15 @@ class Javascript(BaseLanguage):
         :param parent Group:
         :rtype: list[Node]
         """
+        if tree['type'] == 'FunctionIR':
+            if tree['nested_classes']:
+                logging.warning("Skipping class defined within a function!")
+            node = Node(tree['token'], calls_from_ir(tree['body']),
+                        variables_from_ir(tree['body'], parent), parent=parent,
+                        line_number=tree['line'], is_constructor=tree['is_constructor'])
+            subnodes = flatten([Javascript.make_nodes(t, node) for t in tree['nodes']])
+            return [node] + subnodes
+
         is_constructor = False
         if tree.get('kind') == 'constructor':
             token = '(constructor)'
@@ -369,8 +516,12 @@ class Javascript(BaseLanguage):
         :rtype: Node
         """
         token = "(global)"
-        calls = make_calls(lines)
-        variables = make_local_variables(lines, parent)
+        if isinstance(lines, dict):
+            calls = calls_from_ir(lines)
+            variables = variables_from_ir(lines, parent)
+        else:
+            calls = make_calls(lines)
+            variables = make_local_variables(lines, parent)
         root_node = Node(token, calls, variables,
                          line_number=0, parent=parent)
         return root_node
@@ -386,15 +537,20 @@ class Javascript(BaseLanguage):
         :param parent Group:
         :rtype: Group
         """
-        assert tree['type'] == 'ClassDeclaration'
-        subgroup_trees, node_trees, body_trees = Javascript.separate_namespaces(tree)
-        assert not subgroup_trees
-
         group_type = GROUP_TYPE.CLASS
-        token = tree['id']['name']
         display_name = 'Class'
-        line_number = lineno(tree)
-        inherits = get_inherits(tree)
+        if tree['type'] == 'ClassIR':
+            token = tree['token']
+            line_number = tree['line']
+            inherits = tree['inherits']
+            node_trees = tree['nodes']
+        else:
+            assert tree['type'] == 'ClassDeclaration'
+            subgroup_trees, node_trees, body_trees = Javascript.separate_namespaces(tree)
+            assert not subgroup_trees
+            token = tree['id']['name']
+            line_number = lineno(tree)
+            inherits = get_inherits(tree)
         class_group = Group(token, group_type, display_name,
                             inherits=inherits, line_number=line_number, parent=parent)
 
@@ -1,5 +1,10 @@
 import abc
+import bisect
+import collections
+import heapq
+import logging
 import os
+import sys
 
 
 TRUNK_COLOR = '#966F33'
@@ -42,14 +47,30 @@ def is_installed(executable_cmd):
     return False
 
 
+def intern(token):
+    """
+    Tokens repeat constantly (self, this, get, module names...) so they are
+    interned as Calls, Variables, Nodes and Groups are made. Duplicates are
+    stored once and comparing them is an identity check.
+    Anything that isn't a string is returned as-is.
+
+    :param str|Value token:
+    :rtype: str|Value
+    """
+    if type(token) == str:
+        return sys.intern(token)
+    return token
+
+
 def djoin(*tup):
     """
-    Convenience method to join strings with dots
+    Convenience method to join strings with dots. These make up owner tokens
+    and import tokens so the result is interned
     :rtype: str
     """
     if len(tup) == 1 and isinstance(tup[0], list):
-        return '.'.join(tup[0])
-    return '.'.join(tup)
+        return intern('.'.join(tup[0]))
+    return intern('.'.join(tup))
 
 
 def flatten(list_of_lists):
@@ -61,26 +82,36 @@ def flatten(list_of_lists):
     return [el for sublist in list_of_lists for el in sublist]
 
 
-def _resolve_str_variable(variable, file_groups):
+def parse_each(get_tree, filenames, lang_params):
+    """
+    Parse files one at a time.
+    If a file can't be parsed, its exception takes the place of its tree.
+
+    :param function get_tree:
+    :param list[str] filenames:
+    :param LanguageParams lang_params:
+    :rtype: iterator[(str, Tree|Exception)]
+    """
+    for filename in filenames:
+        try:
+            yield filename, get_tree(filename, lang_params)
+        except Exception as ex:
+            yield filename, ex
+
+
+def _resolve_str_variable(variable, symbol_table):
     """
     String variables are when variable.points_to is a string
     This happens ONLY when we have imports that we delayed processing for
 
-    This function looks through all files to see if any particular node matches
+    This function looks up whether any particular node or group matches
     the variable.points_to string
 
     :param Variable variable:
-    :param list[Group] file_groups:
+    :param SymbolTable symbol_table:
     :rtype: Node|Group|str
     """
-    for file_group in file_groups:
-        for node in file_group.all_nodes():
-            if any(ot == variable.points_to for ot in node.import_tokens):
-                return node
-        for group in file_group.all_groups():
-            if any(ot == variable.points_to for ot in group.import_tokens):
-                return group
-    return OWNER_CONST.UNKNOWN_MODULE
+    return symbol_table.by_import_token.get(variable.points_to, OWNER_CONST.UNKNOWN_MODULE)
 
 
 class BaseLanguage(abc.ABC):
@@ -95,8 +126,9 @@ class BaseLanguage(abc.ABC):
 
     @staticmethod
     @abc.abstractmethod
-    def assert_dependencies():
+    def assert_dependencies(lang_params):
         """
+        :param lang_params LanguageParams:
         :rtype: None
         """
 
@@ -108,6 +140,19 @@ class BaseLanguage(abc.ABC):
         :rtype: Tree
         """
 
+    @classmethod
+    def get_trees(cls, filenames, lang_params):
+        """
+        Get the trees for many files, in order. Languages that shell out to
+        an external parser override this to avoid starting a parser per file.
+        If a file can't be parsed, its exception takes the place of its tree.
+
+        :param filenames list[str]:
+        :param lang_params LanguageParams:
+        :rtype: iterator[(str, Tree|Exception)]
+        """
+        return parse_each(cls.get_tree, filenames, lang_params)
+
     @staticmethod
     @abc.abstractmethod
     def separate_namespaces(tree):
@@ -150,6 +195,8 @@ class Variable():
     They may either point to a string or, once resolved, a Group/Node.
     Not all variables can be resolved
     """
+    __slots__ = ('token', 'points_to', 'line_number')
+
     def __init__(self, token, points_to, line_number=None):
         """
         :param str token:
@@ -158,8 +205,8 @@ class Variable():
         """
         assert token
         assert points_to
-        self.token = token
-        self.points_to = points_to
+        self.token = intern(token)
+        self.points_to = intern(points_to)
         self.line_number = line_number
 
     def __repr__(self):
@@ -184,11 +231,23 @@ class Call():
         do_something()
 
     """
-    def __init__(self, token, line_number=None, owner_token=None, definite_constructor=False):
-        self.token = token
-        self.owner_token = owner_token
+    __slots__ = ('token', 'owner_token', 'line_number', 'definite_constructor', 'line_numbers')
+
+    def __init__(self, token, line_number=None, owner_token=None, definite_constructor=False,
+                 line_numbers=None):
+        """
+        :param str token:
+        :param int|None line_number: The earliest line the call is made on
+        :param str|None owner_token:
+        :param bool definite_constructor:
+        :param list[int|None]|None line_numbers: Every line the call is made on.
+                                                 Only set for merged calls to save memory
+        """
+        self.token = intern(token)
+        self.owner_token = intern(owner_token)
         self.line_number = line_number
         self.definite_constructor = definite_constructor
+        self.line_numbers = list(line_numbers) if line_numbers else None
 
     def __repr__(self):
         return f"<Call owner_token={self.owner_token} token={self.token}>"
@@ -203,6 +262,13 @@ class Call():
             return f"{self.owner_token}.{self.token}()"
         return f"{self.token}()"
 
+    def get_line_numbers(self):
+        """
+        Every line this call is made on. Earliest first once merged.
+        :rtype: list[int|None]
+        """
+        return self.line_numbers or [self.line_number]
+
     def is_attr(self):
         """
         Attribute calls are like `a.do_something()` rather than `do_something()`
@@ -210,6 +276,20 @@ class Call():
         """
         return self.owner_token is not None
 
+    def variable_tokens(self):
+        """
+        The tokens of every variable that matches_variable could match.
+        For `do_something()`, this is `do_something`. For `a.do_something()`, it is `a`.
+        For `ns.a.do_something()`, it is also `ns` which might be a namespace variable.
+        :rtype: tuple[str]
+        """
+        if not self.is_attr():
+            return (self.token,)
+        parts = self.owner_token.split('.')
+        if len(parts) == 2:
+            return (self.owner_token, parts[0])
+        return (self.owner_token,)
+
     def matches_variable(self, variable):
         """
         Check whether this variable is what the call is acting on.
@@ -259,18 +339,188 @@ class Call():
         return None
 
 
+def merge_calls(calls):
+    """
+    Collapse calls with the same owner_token, token and definite_constructor
+    into one call which records every line it is made on. The merged call
+    takes the place of the first one and its line_number is the earliest.
+
+    :param list[Call] calls:
+    :rtype: list[Call]
+    """
+    merged = {}
+    for call in calls:
+        key = (call.owner_token, call.token, call.definite_constructor)
+        first = merged.get(key)
+        if first is None:
+            merged[key] = call
+        else:
+            first.line_numbers = first.get_line_numbers() + call.get_line_numbers()
+    ret = list(merged.values())
+    if len(ret) != len(calls):
+        for call in ret:
+            if call.line_numbers:
+                call.line_numbers.sort(key=lambda line_number: line_number or 0)
+                call.line_number = call.line_numbers[0]
+    return ret
+
+
+class Scope():
+    """
+    Scopes are an immutable table of the variables visible in a Node or Group.
+    Variables are indexed by token and sorted with the most recently defined
+    first. Enclosing scopes are referenced rather than copied so every node
+    in a group shares the same parent Scope.
+    """
+    __slots__ = ('parent', 'variables', 'line_keys', 'bindings', 'binding_line_keys')
+
+    def __init__(self, variables, parent=None):
+        """
+        :param list[Variable] variables:
+        :param Scope|None parent:
+        """
+        self.parent = parent
+        self.variables = sorted(variables, key=_line_key)
+        self.line_keys = [_line_key(v) for v in self.variables]
+        self.bindings = collections.defaultdict(list)
+        self.binding_line_keys = collections.defaultdict(list)
+        for i, variable in enumerate(self.variables):
+            self.bindings[variable.token].append((i, variable))
+            self.binding_line_keys[variable.token].append(self.line_keys[i])
+
+    def own_bindings(self, token, line_number=None):
+        """
+        Variables for the token in this scope alone, optionally only those
+        defined on or before line_number. Each is paired with its precedence.
+
+        :param str token:
+        :param int|None line_number:
+        :rtype: list[(int, Variable)]
+        """
+        bindings = self.bindings.get(token)
+        if not bindings:
+            return []
+        if line_number is None:
+            return bindings
+        start = bisect.bisect_left(self.binding_line_keys[token], -line_number)
+        return bindings[start:]
+
+    def visible_version(self, tokens, line_number=None):
+        """
+        Identify which of this scope's own bindings for tokens are visible on
+        line_number. Lookups of the same tokens with the same version see
+        exactly the same variables.
+
+        :param tuple[str] tokens:
+        :param int|None line_number:
+        :rtype: tuple[int]|None
+        """
+        if line_number is None:
+            return None
+        return tuple(bisect.bisect_left(self.binding_line_keys.get(t, []), -line_number)
+                     for t in tokens)
+
+    def binding_scope(self, tokens, line_number=None):
+        """
+        The innermost scope (this one or an enclosing one) with a binding for
+        any of tokens that is visible on line_number, along with its
+        visible_version. lookup only ever yields variables from that scope
+        and the scopes enclosing it, so lookups from different nodes with the
+        same binding scope and version see exactly the same variables.
+        Enclosing scopes are shared between nodes so this is what to key on
+        when memoizing resolution. (None, None) if nothing binds the tokens.
+
+        :param tuple[str] tokens:
+        :param int|None line_number:
+        :rtype: (Scope|None, tuple[int]|None)
+        """
+        scope = self
+        while scope:
+            version = scope.visible_version(tokens, line_number)
+            if version is None:
+                if any(t in scope.bindings for t in tokens):
+                    return scope, None
+            elif any(start < len(scope.binding_line_keys.get(t, []))
+                     for t, start in zip(tokens, version)):
+                return scope, version
+            scope = scope.parent
+            line_number = None
+        return None, None
+
+    def visible_lines(self, tokens, line_numbers):
+        """
+        The earliest of line_numbers for each distinct visible_version of tokens.
+        Lookups on the other lines see exactly the same variables.
+
+        :param tuple[str] tokens:
+        :param list[int|None] line_numbers: Earliest first
+        :rtype: list[int|None]
+        """
+        ret = []
+        versions = set()
+        for line_number in line_numbers:
+            version = self.visible_version(tokens, line_number)
+            if version not in versions:
+                versions.add(version)
+                ret.append(line_number)
+        return ret
+
+    def lookup(self, tokens, line_number=None):
+        """
+        Yield the variables for any of the tokens, innermost scope first.
+        Within the innermost scope, only variables defined on or before
+        line_number are visible.
+
+        :param tuple[str] tokens:
+        :param int|None line_number:
+        :rtype: iterator[Variable]
+        """
+        scope = self
+        while scope:
+            if len(tokens) == 1:
+                bindings = scope.own_bindings(tokens[0], line_number)
+            else:
+                bindings = heapq.merge(*(scope.own_bindings(t, line_number) for t in tokens))
+            for _, variable in bindings:
+                yield variable
+            scope = scope.parent
+            line_number = None
+
+    def all_variables(self, line_number=None):
+        """
+        Every variable in this scope and all enclosing scopes in order of precedence
+
+        :param int|None line_number:
+        :rtype: list[Variable]
+        """
+        ret = []
+        scope = self
+        while scope:
+            start = 0
+            if line_number is not None:
+                start = bisect.bisect_left(scope.line_keys, -line_number)
+            ret += scope.variables[start:]
+            scope = scope.parent
+            line_number = None
+        return ret
+
+
 class Node():
+    __slots__ = ('token', 'line_number', 'calls', 'variables', 'import_tokens', 'parent',
+                 'is_constructor', 'uid', 'scope', 'is_leaf', 'is_trunk')
+
     def __init__(self, token, calls, variables, parent, import_tokens=None,
                  line_number=None, is_constructor=False):
-        self.token = token
+        self.token = intern(token)
         self.line_number = line_number
-        self.calls = calls
+        self.calls = merge_calls(calls)
         self.variables = variables
         self.import_tokens = import_tokens or []
         self.parent = parent
         self.is_constructor = is_constructor
 
         self.uid = "node_" + os.urandom(4).hex()
+        self.scope = None
 
         # Assume it is a leaf and a trunk. These are modified later
         self.is_leaf = True  # it calls nothing else
@@ -353,7 +603,23 @@ class Node():
         Remove this node from it's parent. This effectively deletes the node.
         :rtype: None
         """
-        self.first_group().nodes = [n for n in self.first_group().nodes if n != self]
+        group = self.first_group()
+        group.nodes = [n for n in group.nodes if n != self]
+        group._invalidate_cache()
+
+    def get_scope(self):
+        """
+        The Scope of this node. This is built on first use so every variable
+        must be in place (and the tree final) by the time calls are linked.
+        :rtype: Scope
+        """
+        if self.scope is None:
+            if isinstance(self.parent, Group):
+                parent_scope = self.parent.get_member_scope()
+            else:
+                parent_scope = self.parent.get_scope()
+            self.scope = Scope(self.variables, parent_scope)
+        return self.scope
 
     def get_variables(self, line_number=None):
         """
@@ -361,31 +627,19 @@ class Node():
         This includes all local variables as-well-as outer-scope variables
         :rtype: list[Variable]
         """
-        if line_number is None:
-            ret = list(self.variables)
-        else:
-            # TODO variables should be sorted by scope before line_number
-            ret = list([v for v in self.variables if v.line_number <= line_number])
-        if any(v.line_number for v in ret):
-            ret.sort(key=lambda v: v.line_number, reverse=True)
+        return self.get_scope().all_variables(line_number)
 
-        parent = self.parent
-        while parent:
-            ret += parent.get_variables()
-            parent = parent.parent
-        return ret
-
-    def resolve_variables(self, file_groups):
+    def resolve_variables(self, symbol_table):
         """
         For all variables, attempt to resolve the Node/Group on points_to.
         There is a good chance this will be unsuccessful.
 
-        :param list[Group] file_groups:
+        :param SymbolTable symbol_table:
         :rtype: None
         """
         for variable in self.variables:
             if isinstance(variable.points_to, str):
-                variable.points_to = _resolve_str_variable(variable, file_groups)
+                variable.points_to = _resolve_str_variable(variable, symbol_table)
             elif isinstance(variable.points_to, Call):
                 # else, this is a call variable
                 call = variable.points_to
@@ -393,11 +647,10 @@ class Node():
                 if call.is_attr() and not call.definite_constructor:
                     continue
                 # Else, assume the call is a constructor.
-                # iterate through to find the right group
-                for file_group in file_groups:
-                    for group in file_group.all_groups():
-                        if group.token == call.token:
-                            variable.points_to = group
+                # If several groups share the token, the last one found wins
+                groups = symbol_table.groups_by_token.get(call.token)
+                if groups:
+                    variable.points_to = groups[-1]
             else:
                 assert isinstance(variable.points_to, (Node, Group))
 
@@ -447,7 +700,80 @@ def _wrap_as_variables(sequence):
     return [Variable(el.token, el, el.line_number) for el in sequence]
 
 
+def _line_key(variable):
+    """
+    Sort key to put the most recently defined variables first.
+    Variables without a line number sort as if defined on line 0.
+    :param Variable variable:
+    :rtype: int
+    """
+    return -(variable.line_number or 0)
+
+
+class SymbolTable():
+    """
+    Token-indexed lookup of every node and group we know about. This is built
+    once per run, before variables are resolved, so that resolving an import
+    or linking a call to its possible definitions is a dictionary lookup rather
+    than a scan of every file.
+    """
+    def __init__(self, file_groups):
+        """
+        :param list[Group] file_groups:
+        """
+        self.nodes_by_token = collections.defaultdict(list)
+        self.file_nodes_by_token = collections.defaultdict(list)
+        self.constructors_by_class_token = collections.defaultdict(list)
+        self.groups_by_token = collections.defaultdict(list)
+        self.by_import_token = {}
+        for file_group in file_groups:
+            for node in file_group.iter_nodes():
+                self.nodes_by_token[node.token].append(node)
+                if isinstance(node.parent, Group) and node.parent.group_type == GROUP_TYPE.FILE:
+                    self.file_nodes_by_token[node.token].append(node)
+                if node.is_constructor:
+                    self.constructors_by_class_token[node.parent.token].append(node)
+                self._add_import_tokens(node)
+            for group in file_group.iter_groups():
+                self.groups_by_token[group.token].append(group)
+                self._add_import_tokens(group)
+
+    def _add_import_tokens(self, node_or_group):
+        """
+        Index the import tokens of a node or group. When several share an
+        import token, the first one found wins.
+
+        :param Node|Group node_or_group:
+        """
+        for import_token in node_or_group.import_tokens:
+            self.by_import_token.setdefault(import_token, node_or_group)
+
+    def possible_nodes(self, call, node_a):
+        """
+        All nodes that call (which happened on node_a) might link to
+        if we don't know anything about the variables involved.
+
+        :param Call call:
+        :param Node node_a:
+        :rtype: list[Node]
+        """
+        if call.is_attr():
+            # checking node.parent != file_group prevents self linkage in cases like
+            # function a() {b = Obj(); b.a()}
+            file_group = node_a.file_group()
+            return [node for node in self.nodes_by_token.get(call.token, [])
+                    if node.parent != file_group]
+
+        possible_nodes = list(self.file_nodes_by_token.get(call.token, []))
+        for node in self.constructors_by_class_token.get(call.token, []):
+            if node not in possible_nodes:
+                possible_nodes.append(node)
+        return possible_nodes
+
+
 class Edge():
+    __slots__ = ('node0', 'node1')
+
     def __init__(self, node0, node1):
         self.node0 = node0
         self.node1 = node1
@@ -491,9 +817,13 @@ class Group():
     """
     Groups represent namespaces (classes and modules/files)
     """
+    __slots__ = ('token', 'line_number', 'nodes', 'root_node', 'subgroups', 'parent',
+                 'group_type', 'display_type', 'import_tokens', 'inherits', 'uid', 'scope',
+                 'member_variables', 'member_scope', '_all_nodes', '_all_groups')
+
     def __init__(self, token, group_type, display_type, import_tokens=None,
                  line_number=None, parent=None, inherits=None):
-        self.token = token
+        self.token = intern(token)
         self.line_number = line_number
         self.nodes = []
         self.root_node = None
@@ -506,6 +836,18 @@ class Group():
         assert group_type in GROUP_TYPE
 
         self.uid = "cluster_" + os.urandom(4).hex()  # group doesn't work by syntax rules
+        self.scope = None
+
+        # Variables that every node in this group can see but which aren't
+        # visible to the group itself (e.g. sibling methods in Ruby, inherited
+        # methods). They are shared through get_member_scope rather than
+        # copied onto each node.
+        self.member_variables = []
+        self.member_scope = None
+
+        # Flattened views of the tree. These are cleared by _invalidate_cache
+        self._all_nodes = None
+        self._all_groups = None
 
     def __repr__(self):
         return f"<Group token={self.token} type={self.display_type}>"
@@ -535,6 +877,7 @@ class Group():
         :param sg Group:
         """
         self.subgroups.append(sg)
+        self._invalidate_cache()
 
     def add_node(self, node, is_root=False):
         """
@@ -545,16 +888,53 @@ class Group():
         self.nodes.append(node)
         if is_root:
             self.root_node = node
+        self._invalidate_cache()
+
+    def _invalidate_cache(self):
+        """
+        Clear the flattened views of this group and every group containing it.
+        This must be called whenever nodes or subgroups change.
+        :rtype: None
+        """
+        group = self
+        while group:
+            group._all_nodes = None
+            group._all_groups = None
+            group = group.parent
+
+    def iter_nodes(self):
+        """
+        Iterate through the nodes that are part of this group + all subgroups
+        in the same order as all_nodes without building a list
+        :rtype: iterator[Node]
+        """
+        stack = [self]
+        while stack:
+            group = stack.pop()
+            yield from group.nodes
+            stack.extend(reversed(group.subgroups))
+
+    def iter_groups(self):
+        """
+        Iterate through this group + all subgroups in the same order as
+        all_groups without building a list
+        :rtype: iterator[Group]
+        """
+        stack = [self]
+        while stack:
+            group = stack.pop()
+            yield group
+            stack.extend(reversed(group.subgroups))
 
     def all_nodes(self):
         """
-        List of nodes that are part of this group + all subgroups
+        List of nodes that are part of this group + all subgroups.
+        This is cached until the tree changes so don't modify it.
         :rtype: list[Node]
         """
-        ret = list(self.nodes)
-        for subgroup in self.subgroups:
-            ret += subgroup.all_nodes()
-        return ret
+        if self._all_nodes is None:
+            self._all_nodes = list(self.iter_nodes())
+        return self._all_nodes
 
     def get_constructor(self):
         """
@@ -570,13 +950,13 @@ class Group():
 
     def all_groups(self):
         """
-        List of groups that are part of this group + all subgroups
+        List of groups that are part of this group + all subgroups.
+        This is cached until the tree changes so don't modify it.
         :rtype: list[Group]
         """
-        ret = [self]
-        for subgroup in self.subgroups:
-            ret += subgroup.all_groups()
-        return ret
+        if self._all_groups is None:
+            self._all_groups = list(self.iter_groups())
+        return self._all_groups
 
     def get_variables(self, line_number=None):
         """
@@ -598,6 +978,29 @@ class Group():
         else:
             return []
 
+    def get_scope(self):
+        """
+        The Scope of this group. Like Node.get_scope, this is built on first use.
+        :rtype: Scope
+        """
+        if self.scope is None:
+            parent_scope = self.parent.get_scope() if self.parent else None
+            self.scope = Scope(self.get_variables(), parent_scope)
+        return self.scope
+
+    def get_member_scope(self):
+        """
+        The Scope enclosing the nodes of this group. This is the table of
+        member_variables inside the group's own Scope. Every node in the group
+        shares it. Like get_scope, this is built on first use.
+        :rtype: Scope
+        """
+        if not self.member_variables:
+            return self.get_scope()
+        if self.member_scope is None:
+            self.member_scope = Scope(self.member_variables, self.get_scope())
+        return self.member_scope
+
     def remove_from_parent(self):
         """
         Remove this group from it's parent. This is effectively a deletion
@@ -605,6 +1008,31 @@ class Group():
         """
         if self.parent:
             self.parent.subgroups = [g for g in self.parent.subgroups if g != self]
+            self.parent._invalidate_cache()
+
+    def prune(self, keep_nodes, keep_empty_groups=False):
+        """
+        Remove every node in this group and its subgroups that is not in keep_nodes.
+        Unless keep_empty_groups, also remove subgroups that are left without nodes.
+        This rebuilds the tree in one post-order pass rather than removing
+        nodes and groups one at a time.
+
+        :param set[Node] keep_nodes:
+        :param bool keep_empty_groups:
+        :returns: Whether any nodes remain in this group or its subgroups
+        :rtype: bool
+        """
+        has_nodes = False
+        subgroups = []
+        for subgroup in self.subgroups:
+            subgroup_has_nodes = subgroup.prune(keep_nodes, keep_empty_groups)
+            if subgroup_has_nodes or keep_empty_groups:
+                subgroups.append(subgroup)
+            has_nodes = has_nodes or subgroup_has_nodes
+        self.subgroups = subgroups
+        self.nodes = [n for n in self.nodes if n in keep_nodes]
+        self._invalidate_cache()
+        return has_nodes or bool(self.nodes)
 
     def all_parents(self):
         """
@@ -648,3 +1076,121 @@ class Group():
                                        subgroup.to_dot().split('\n'))).strip() + '\n'
         ret += '};\n'
         return ret
+
+
+class FileSummary():
+    """
+    A flat, picklable summary of a file group as it comes out of the language's
+    make_* functions. This is what parsing processes send back instead of the
+    trees or the Groups/Nodes themselves. It is made of plain tuples which
+    reference each other by index so it pickles small and fast.
+
+    groups: (token, group_type, display_type, import_tokens, line_number,
+             inherits, parent group index|None, root node index|None, member_variables)
+    nodes: (token, line_number, is_constructor, import_tokens, group index,
+            parent index, parent is a node, calls, variables)
+    calls: (token, line_number, owner_token, definite_constructor, line_numbers)
+    variables: (token, line_number, kind, points_to) where kind says whether
+               points_to is a string, a call, or a node/group index
+    Groups are in pre-order and the file group is first.
+    """
+    __slots__ = ('groups', 'nodes')
+
+    def __init__(self, groups, nodes):
+        self.groups = groups
+        self.nodes = nodes
+
+    @staticmethod
+    def from_file_group(file_group):
+        """
+        :param Group file_group:
+        :rtype: FileSummary
+        """
+        all_groups = list(file_group.iter_groups())
+        group_indexes = {id(group): i for i, group in enumerate(all_groups)}
+        all_nodes = []
+        node_groups = []
+        for i, group in enumerate(all_groups):
+            all_nodes += group.nodes
+            node_groups += [i] * len(group.nodes)
+        node_indexes = {id(node): i for i, node in enumerate(all_nodes)}
+
+        def summarize_call(call):
+            return (call.token, call.line_number, call.owner_token, call.definite_constructor,
+                    call.line_numbers and tuple(call.line_numbers))
+
+        def summarize_variable(variable):
+            points_to = variable.points_to
+            if isinstance(points_to, str):
+                kind, points_to = 'str', points_to
+            elif isinstance(points_to, Call):
+                kind, points_to = 'call', summarize_call(points_to)
+            elif isinstance(points_to, Node):
+                kind, points_to = 'node', node_indexes[id(points_to)]
+            else:
+                kind, points_to = 'group', group_indexes[id(points_to)]
+            return (variable.token, variable.line_number, kind, points_to)
+
+        groups = []
+        for group in all_groups:
+            groups.append((group.token, group.group_type, group.display_type,
+                           group.import_tokens, group.line_number, group.inherits,
+                           group_indexes[id(group.parent)] if group.parent else None,
+                           node_indexes[id(group.root_node)] if group.root_node else None,
+                           tuple(summarize_variable(v) for v in group.member_variables)))
+        nodes = []
+        for node, group_index in zip(all_nodes, node_groups):
+            parent_is_node = isinstance(node.parent, Node)
+            parent_index = (node_indexes if parent_is_node else group_indexes)[id(node.parent)]
+            nodes.append((node.token, node.line_number, node.is_constructor,
+                          node.import_tokens, group_index,
+                          parent_index, parent_is_node,
+                          tuple(summarize_call(c) for c in node.calls),
+                          tuple(summarize_variable(v) for v in node.variables)))
+        return FileSummary(groups, nodes)
+
+    def to_file_group(self):
+        """
+        Rebuild the file group. The result is the same as the group which was
+        summarized with new uids.
+        :rtype: Group
+        """
+        groups = []
+        for token, group_type, display_type, import_tokens, line_number, \
+                inherits, parent_index, _, _ in self.groups:
+            parent = groups[parent_index] if parent_index is not None else None
+            group = Group(token, group_type, display_type, import_tokens=list(import_tokens),
+                          line_number=line_number, parent=parent, inherits=list(inherits))
+            if parent:
+                parent.add_subgroup(group)
+            groups.append(group)
+
+        nodes = []
+        for token, line_number, is_constructor, import_tokens, group_index, \
+                _, _, calls, _ in self.nodes:
+            calls = [Call(*call) for call in calls]
+            nodes.append(Node(token, calls, [], groups[group_index],
+                              import_tokens=list(import_tokens), line_number=line_number,
+                              is_constructor=is_constructor))
+
+        def make_variable(token, line_number, kind, points_to):
+            if kind == 'call':
+                points_to = Call(*points_to)
+            elif kind == 'node':
+                points_to = nodes[points_to]
+            elif kind == 'group':
+                points_to = groups[points_to]
+            return Variable(token, points_to, line_number)
+
+        # Parents and variables can point forward so they are set once everything exists
+        for node, (_, _, _, _, group_index, parent_index, parent_is_node, _,
+                   variables) in zip(nodes, self.nodes):
+            node.parent = (nodes if parent_is_node else groups)[parent_index]
+            node.variables = [make_variable(*variable) for variable in variables]
+            groups[group_index].add_node(node)
+
+        for group, summary in zip(groups, self.groups):
+            if summary[7] is not None:
+                group.root_node = nodes[summary[7]]
+            group.member_variables = [make_variable(*variable) for variable in summary[8]]
+        return groups[0]
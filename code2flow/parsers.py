@@ -0,0 +1,430 @@
+import abc
+import asyncio
+import atexit
+import collections
+import json
+import logging
+import os
+import struct
+import subprocess
+import tempfile
+
+from .model import BaseLanguage
+
+
+class ParserCrashedError(Exception):
+    """
+    Raised when a long-lived parser process dies or stops making sense.
+    Parse errors in individual files are not crashes.
+    """
+
+
+class ParserProcess():
+    """
+    A long-lived external parser.
+    Requests are written to stdin as one JSON object per line. Each response
+    is a JSON object prefixed by its 4-byte big-endian length. The first
+    response is a handshake describing the parser (e.g. its version).
+    """
+    def __init__(self, cmd):
+        """
+        :param list[str] cmd:
+        """
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=self.stderr)
+        except OSError as ex:
+            self.stderr.close()
+            raise ParserCrashedError(str(ex)) from None
+        try:
+            self.handshake = self.read()
+        except ParserCrashedError:
+            # Nothing else will hold on to this process so don't leave it behind
+            self.close()
+            raise
+
+    def error_output(self):
+        """
+        Whatever the parser wrote to stderr. For error messages
+        :rtype: str
+        """
+        try:
+            self.stderr.seek(0)
+            return self.stderr.read().decode(errors='replace')
+        except ValueError:
+            return ''
+
+    def send(self, request):
+        """
+        :param dict request:
+        :rtype: None
+        """
+        try:
+            self.proc.stdin.write(json.dumps(request).encode() + b'\n')
+            self.proc.stdin.flush()
+        except (OSError, ValueError):
+            raise ParserCrashedError(self.error_output()) from None
+
+    def read(self):
+        """
+        Read the next response
+        :rtype: dict
+        """
+        header = self.proc.stdout.read(4)
+        if len(header) < 4:
+            raise ParserCrashedError(self.error_output())
+        length = struct.unpack('>I', header)[0]
+        body = self.proc.stdout.read(length)
+        if len(body) < length:
+            raise ParserCrashedError(self.error_output())
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ParserCrashedError("Parser returned invalid JSON") from None
+
+    def close(self):
+        """
+        Ask the parser to exit by closing its stdin. Kill it if it won't.
+        :rtype: None
+        """
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.stderr.close()
+
+
+class ParserPool():
+    """
+    A pool of long-lived parser processes, started lazily and reused across runs.
+    Requests are spread round-robin across processes and a few are kept in
+    flight so that the parsers never wait on us. Responses are returned in the
+    same order as the requests.
+    """
+    _for_process = {}
+
+    def __init__(self, cmd):
+        """
+        :param list[str] cmd:
+        """
+        self.cmd = cmd
+        self.processes = []
+        self.pid = os.getpid()
+
+    @classmethod
+    def for_current_process(cls, cmd):
+        """
+        The pool for this command which every run in this process shares.
+        Its parsers are started on first use and closed at exit. A forked
+        child can't share its parent's pipes so it gets a pool of its own.
+
+        :param list[str] cmd:
+        :rtype: ParserPool
+        """
+        pool = cls._for_process.get(tuple(cmd))
+        if not pool or pool.pid != os.getpid():
+            pool = cls._for_process[tuple(cmd)] = cls(cmd)
+            atexit.register(pool.close)
+        return pool
+
+    def _get_processes(self, num):
+        while len(self.processes) < num:
+            self.processes.append(ParserProcess(self.cmd))
+        return self.processes[:num]
+
+    def handshake(self):
+        """
+        The handshake from the first parser process
+        :rtype: dict
+        """
+        return self._get_processes(1)[0].handshake
+
+    def parse(self, requests, in_flight, num_processes=1):
+        """
+        Send every request and yield the responses in order.
+        Each request is given an 'id' which every response must echo back.
+
+        :param iterator[dict] requests:
+        :param int in_flight: Maximum number of requests sent but not yet yielded
+        :param int num_processes:
+        :rtype: iterator[dict]
+        """
+        in_flight = max(in_flight, 1)
+        processes = self._get_processes(max(min(num_processes, in_flight), 1))
+        requests = iter(requests)
+        owners = {}
+        responses = {}
+        num_sent = 0
+        num_done = 0
+        try:
+            while True:
+                while num_sent - num_done < in_flight:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    request['id'] = num_sent
+                    owner = processes[num_sent % len(processes)]
+                    owner.send(request)
+                    owners[num_sent] = owner
+                    num_sent += 1
+                if num_done == num_sent:
+                    return
+                owner = owners.pop(num_done)
+                while num_done not in responses:
+                    response = owner.read()
+                    if response.get('id') not in owners and response.get('id') != num_done:
+                        raise ParserCrashedError("Parser returned an unexpected response")
+                    responses[response['id']] = response
+                response = responses.pop(num_done)
+                num_done += 1
+                yield response
+                del response
+        finally:
+            if num_done != num_sent:
+                # Abandoned or crashed midway. Responses still in the pipes would
+                # confuse the next caller so start over with fresh processes.
+                self.close()
+
+    def close(self):
+        """
+        :rtype: None
+        """
+        processes, self.processes = self.processes, []
+        for process in processes:
+            process.close()
+
+
+def run_parser_subprocesses(cmds, concurrency):
+    """
+    Run one parser subprocess per command with up to `concurrency` running
+    at once. Yields (returncode, stdout) for each command in order.
+    Subprocesses are only started as results are consumed, so no more than
+    `concurrency` outputs are held at a time. If a command can't be run,
+    its exception is yielded instead.
+
+    :param iterator[list[str]] cmds:
+    :param int concurrency:
+    :rtype: iterator[(int, bytes)|Exception]
+    """
+    async def run(cmd):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except OSError as ex:
+            return ex
+        try:
+            stdout, _ = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        return proc.returncode, stdout
+
+    loop = asyncio.new_event_loop()
+    cmds = iter(cmds)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < max(concurrency, 1):
+                cmd = next(cmds, None)
+                if cmd is None:
+                    break
+                pending.append(loop.create_task(run(cmd)))
+            if not pending:
+                return
+            yield loop.run_until_complete(pending.popleft())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+def parse_subprocesses(language, filenames, lang_params, concurrency):
+    """
+    Parse each file with its own parser subprocess, several at once.
+    If a file can't be parsed, its exception takes the place of its tree.
+
+    :param BaseLanguage language: Implements get_tree_cmd and tree_from_output
+    :param list[str] filenames:
+    :param LanguageParams lang_params:
+    :param int concurrency:
+    :rtype: iterator[(str, Tree|Exception)]
+    """
+    cmds = (language.get_tree_cmd(filename, lang_params) for filename in filenames)
+    for filename, result in zip(filenames, run_parser_subprocesses(cmds, concurrency)):
+        if isinstance(result, Exception):
+            yield filename, result
+            continue
+        try:
+            tree = language.tree_from_output(filename, *result)
+        except Exception as ex:
+            tree = ex
+        del result
+        yield filename, tree
+        del tree
+
+
+def parse_with_pool(language, filenames, lang_params, num_processes=1, in_flight=None):
+    """
+    Parse files with the language's long-lived ParserPool.
+    If the pool crashes, parse the rest of the files with one parser
+    subprocess per file. If lang_params.parser_workers is 0, don't use
+    the pool at all.
+
+    :param PooledLanguage language:
+    :param list[str] filenames:
+    :param LanguageParams lang_params:
+    :param int num_processes:
+    :param int|None in_flight: Defaults to lang_params.parser_workers
+    :rtype: iterator[(str, Tree|Exception)]
+    """
+    concurrency = lang_params.parser_workers or os.cpu_count() or 1
+    if not lang_params.parser_workers:
+        yield from parse_subprocesses(language, filenames, lang_params, concurrency)
+        return
+
+    pool = language.get_pool()
+    requests = (language.make_request(filename, lang_params) for filename in filenames)
+    num_done = 0
+    try:
+        responses = pool.parse(requests, in_flight or lang_params.parser_workers,
+                               num_processes)
+        for filename, response in zip(filenames, responses):
+            try:
+                tree = language.tree_from_response(filename, response)
+            except Exception as ex:
+                tree = ex
+            del response
+            num_done += 1
+            yield filename, tree
+            # Don't hold on to the tree while the next one is parsed
+            del tree
+    except ParserCrashedError as ex:
+        logging.warning("Parser process %r crashed. Falling back to one process "
+                        "per file. %s", pool.cmd[0], ex)
+        yield from parse_subprocesses(language, filenames[num_done:], lang_params,
+                                      concurrency)
+
+
+class PooledLanguage(BaseLanguage):
+    """
+    A language whose files are parsed by an external parser which prints
+    JSON. Files are sent to a ParserPool of long-lived parser processes.
+    Subclasses supply the commands, the requests, and what to tell the
+    user when a file can't be parsed.
+    """
+
+    # The pool runs one parser process per worker with two files in flight
+    # for each so that no process waits on us. A parser which spreads files
+    # across its own threads sets this to False and gets a single process.
+    PROCESS_PER_WORKER = True
+
+    @staticmethod
+    @abc.abstractmethod
+    def get_pool():
+        """
+        :rtype: ParserPool
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def get_tree_cmd(filename, lang_params):
+        """
+        The command to parse a single file with its own parser subprocess
+
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: list[str]
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def make_request(filename, lang_params):
+        """
+        The request to parse a single file with the pool
+
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: dict
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def parse_error(filename):
+        """
+        :param filename str:
+        :rtype: AssertionError
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def check_tree(tree):
+        """
+        Raise if the parser sent back something other than a tree we can use
+
+        :param tree Tree:
+        :rtype: Tree
+        """
+
+    @classmethod
+    def get_tree(cls, filename, lang_params):
+        """
+        Get the tree for this file from its own parser subprocess
+
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: Tree
+        """
+        cmd = cls.get_tree_cmd(filename, lang_params)
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return cls.tree_from_output(filename, proc.returncode, proc.stdout)
+
+    @classmethod
+    def tree_from_output(cls, filename, returncode, output):
+        """
+        :param filename str:
+        :param returncode int:
+        :param output bytes:
+        :rtype: Tree
+        """
+        if returncode:
+            raise cls.parse_error(filename)
+        try:
+            tree = json.loads(output)
+        except ValueError:
+            raise cls.parse_error(filename) from None
+        return cls.check_tree(tree)
+
+    @classmethod
+    def tree_from_response(cls, filename, response):
+        """
+        :param filename str:
+        :param response dict:
+        :rtype: Tree
+        """
+        if 'error' in response:
+            logging.debug("Could not parse %r: %s", filename, response['error'])
+            raise cls.parse_error(filename)
+        return cls.check_tree(response['tree'])
+
+    @classmethod
+    def get_trees(cls, filenames, lang_params):
+        """
+        :param filenames list[str]:
+        :param lang_params LanguageParams:
+        :rtype: iterator[(str, Tree|Exception)]
+        """
+        if cls.PROCESS_PER_WORKER:
+            return parse_with_pool(cls, filenames, lang_params,
+                                   num_processes=lang_params.parser_workers,
+                                   in_flight=lang_params.parser_workers * 2)
+        return parse_with_pool(cls, filenames, lang_params)
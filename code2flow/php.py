@@ -1,9 +1,13 @@
 import json
+import logging
 import os
 import subprocess
 
-from .model import (Group, Node, Call, Variable, BaseLanguage,
-                    OWNER_CONST, GROUP_TYPE, is_installed, flatten, djoin)
+from .model import (Group, Node, Call, Variable, OWNER_CONST, GROUP_TYPE,
+                    is_installed, flatten, djoin)
+from .parsers import ParserPool, ParserCrashedError, PooledLanguage
+
+SCRIPT_LOC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "get_ast.php")
 
 
 def lineno(tree):
@@ -34,6 +38,11 @@ def get_name(tree, from_='name'):
     return None
 
 
+# The node types that get_call_from_expr can make a Call from
+CALL_NODE_TYPES = ('Expr_FuncCall', 'Expr_New', 'Expr_MethodCall',
+                   'Expr_BinaryOp_Concat', 'Expr_StaticCall')
+
+
 def get_call_from_expr(func_expr):
     """
     Given an ast that represents a send call, clear and create our
@@ -78,54 +87,52 @@ def get_call_from_expr(func_expr):
     return ret
 
 
-def walk(tree):
+def walk(tree, types=None):
     """
     Given an ast tree walk it to get every node. For PHP, the exception
-    is that we return Expr_BinaryOp_Concat which has internal nodes but
+    is that we don't walk into Expr_BinaryOp_Concat which has internal nodes but
     is important to process as a whole.
+    Uses an explicit stack so deeply nested code can't hit the recursion limit.
 
     :param tree_el ast:
-    :rtype: list[ast]
+    :param tuple[str]|None types: If given, only yield nodes of these types
+    :rtype: iterator[ast]
     """
-
     if isinstance(tree, list):
-        ret = []
-        for el in tree:
-            if isinstance(el, dict) and el.get('nodeType'):
-                ret += walk(el)
-        return ret
-
-    assert isinstance(tree, dict)
-    assert tree['nodeType']
-    ret = [tree]
-
-    if tree['nodeType'] == 'Expr_BinaryOp_Concat':
-        return ret
-
-    for v in tree.values():
-        if isinstance(v, list) or (isinstance(v, dict) and v.get('nodeType')):
-            ret += walk(v)
-    return ret
+        stack = [el for el in tree if isinstance(el, dict) and el.get('nodeType')]
+    else:
+        assert isinstance(tree, dict)
+        assert tree['nodeType']
+        stack = [tree]
+    stack = [iter(stack)]
+
+    while stack:
+        el = next(stack[-1], None)
+        if el is None:
+            stack.pop()
+            continue
+        if types is None or el['nodeType'] in types:
+            yield el
+        if el['nodeType'] != 'Expr_BinaryOp_Concat':
+            stack.append(children(el))
 
 
 def children(tree):
     """
-    Given an ast tree get all children. For PHP, children are anything
-    with a nodeType.
+    Given an ast tree iterate through all children. For PHP, children are
+    anything with a nodeType.
 
     :param tree_el ast:
-    :rtype: list[ast]
+    :rtype: iterator[ast]
     """
     assert isinstance(tree, dict)
-    ret = []
     for v in tree.values():
         if isinstance(v, list):
             for el in v:
                 if isinstance(el, dict) and el.get('nodeType'):
-                    ret.append(el)
+                    yield el
         elif isinstance(v, dict) and v.get('nodeType'):
-            ret.append(v)
-    return ret
+            yield v
 
 
 def make_calls(body_el):
@@ -136,7 +143,7 @@ def make_calls(body_el):
     :rtype: list[Call]
     """
     calls = []
-    for expr in walk(body_el):
+    for expr in walk(body_el, CALL_NODE_TYPES):
         call = get_call_from_expr(expr)
         calls.append(call)
     ret = list(filter(None, calls))
@@ -174,7 +181,7 @@ def make_local_variables(tree_el, parent):
     :rtype: list[Variable]
     """
     variables = []
-    for el in walk(tree_el):
+    for el in walk(tree_el, ('Expr_Assign', 'Stmt_Use')):
         if el['nodeType'] == 'Expr_Assign':
             variables.append(process_assign(el))
         if el['nodeType'] == 'Stmt_Use':
@@ -211,53 +218,99 @@ def get_inherits(tree):
     return ret
 
 
-def run_ast_parser(filename):
+def get_php_versions(lang_params):
     """
-    Parse the php file and return the output + the returncode
-    Separate function b/c unittesting and asserting php-parser installation.
-    :param filename str:
-    :type: str, int
+    The versions of php and php-parser. If we are going to parse with the
+    pool, these are from its handshake. Otherwise, ask get_ast.php once.
+
+    :param lang_params LanguageParams:
+    :rtype: dict
     """
+    if lang_params.parser_workers:
+        return get_php_pool().handshake()
+    proc = subprocess.run(["php", SCRIPT_LOC, "--version"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        raise ParserCrashedError(proc.stderr.decode(errors='replace'))
+    return json.loads(proc.stdout)
 
-    script_loc = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                              "get_ast.php")
-    cmd = ["php", script_loc, filename]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return proc.communicate()[0], proc.returncode
+
+def get_php_pool():
+    """
+    Get the pool of long-lived php processes which parse files with php-parser
+    :rtype: ParserPool
+    """
+    return ParserPool.for_current_process(["php", SCRIPT_LOC, "--serve"])
 
 
-class PHP(BaseLanguage):
+class PHP(PooledLanguage):
     @staticmethod
-    def assert_dependencies():
-        """Assert that php and php-parser are installed"""
+    def assert_dependencies(lang_params):
+        """
+        Assert that php and php-parser 4 are installed. The pool of php
+        processes is only started if we are going to parse with it.
+
+        :param lang_params LanguageParams:
+        """
         assert is_installed('php'), "No php installation could be found"
-        self_ref = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                "get_ast.php")
-        outp, returncode = run_ast_parser(self_ref)
         path = os.path.dirname(os.path.realpath(__file__))
         assert_msg = 'Error running the PHP parser. From the `%s` directory, run ' \
                      '`composer require nikic/php-parser "^4.10"`.' % path
-        assert not returncode, assert_msg
-        return outp
+        try:
+            versions = get_php_versions(lang_params)
+        except (ParserCrashedError, ValueError) as ex:
+            raise AssertionError(assert_msg + "\n" + str(ex)) from None
+        parser_version = versions['parser_version'].lstrip('v')
+        assert parser_version.split('.')[0] == '4', \
+            assert_msg + "\nphp-parser %s was found." % parser_version
+        logging.info("Using PHP %s and php-parser %s", versions['version'], parser_version)
+
+    @staticmethod
+    def get_pool():
+        """
+        :rtype: ParserPool
+        """
+        return get_php_pool()
 
     @staticmethod
-    def get_tree(filename, lang_params):
+    def get_tree_cmd(filename, lang_params):
         """
-        Get the entire AST for this file
+        The command to parse a single file with its own php process.
+        Either way, get_ast.php reduces the tree to what we use here but
+        keeps php-parser's shape.
 
         :param filename str:
         :param lang_params LanguageParams:
-        :rtype: ast
+        :rtype: list[str]
+        """
+        return ["php", SCRIPT_LOC, filename]
+
+    @staticmethod
+    def make_request(filename, lang_params):
+        """
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: dict
         """
+        return {'file': os.path.abspath(filename)}
 
-        outp, returncode = run_ast_parser(filename)
-        if returncode:
-            raise AssertionError(
-                "Could not parse file %r. You may have a syntax error. "
-                "For more detail, try running with `php %s`. " %
-                (filename, filename))
+    @staticmethod
+    def parse_error(filename):
+        """
+        :param filename str:
+        :rtype: AssertionError
+        """
+        return AssertionError(
+            "Could not parse file %r. You may have a syntax error. "
+            "For more detail, try running with `php %s`. " %
+            (filename, filename))
 
-        tree = json.loads(outp)
+    @staticmethod
+    def check_tree(tree):
+        """
+        :param tree ast:
+        :rtype: ast
+        """
         assert isinstance(tree, list)
         if len(tree) == 1 and tree[0]['nodeType'] == 'Stmt_InlineHTML':
             raise AssertionError("Tried to parse a file that is not likely PHP")
@@ -277,23 +330,30 @@ class PHP(BaseLanguage):
         """
         tree = tree or []  # if its abstract, it comes in with no body
 
-        groups = []
-        nodes = []
-        body = []
-        for el in tree:
-            if el['nodeType'] in ('Stmt_Function', 'Stmt_ClassMethod', 'Expr_Closure'):
-                nodes.append(el)
-            elif el['nodeType'] in ('Stmt_Class', 'Stmt_Namespace', 'Stmt_Trait'):
-                groups.append(el)
-            else:
-                tup = PHP.separate_namespaces(children(el))
-                if tup[0] or tup[1]:
-                    groups += tup[0]
-                    nodes += tup[1]
-                    body += tup[2]
+        # Each frame is (element, its remaining children, groups, nodes, body).
+        # When an element is finished, its results are merged into its parent's
+        # if it contained groups or nodes. Otherwise, it is part of the body.
+        stack = [(None, iter(tree), [], [], [])]
+        while True:
+            el, remaining, groups, nodes, body = stack[-1]
+            child = next(remaining, None)
+            if child is None:
+                stack.pop()
+                if not stack:
+                    return groups, nodes, body
+                parent_groups, parent_nodes, parent_body = stack[-1][2:]
+                if groups or nodes:
+                    parent_groups += groups
+                    parent_nodes += nodes
+                    parent_body += body
                 else:
-                    body.append(el)
-        return groups, nodes, body
+                    parent_body.append(el)
+            elif child['nodeType'] in ('Stmt_Function', 'Stmt_ClassMethod', 'Expr_Closure'):
+                nodes.append(child)
+            elif child['nodeType'] in ('Stmt_Class', 'Stmt_Namespace', 'Stmt_Trait'):
+                groups.append(child)
+            else:
+                stack.append((child, children(child), [], [], []))
 
     @staticmethod
     def make_nodes(tree, parent):
@@ -392,9 +452,8 @@ class PHP(BaseLanguage):
 
         if group_type == GROUP_TYPE.NAMESPACE:
             class_group.add_node(PHP.make_root_node(body_trees, class_group))
-            for node in class_group.nodes:
-                node.variables += [Variable(n.token, n, line_number=n.line_number)
-                                   for n in class_group.nodes]
+            class_group.member_variables = [Variable(n.token, n, line_number=n.line_number)
+                                            for n in class_group.nodes]
 
         return class_group
 
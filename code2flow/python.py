@@ -38,25 +38,6 @@ def get_call_from_func_element(func):
         return None
 
 
-def make_calls(lines):
-    """
-    Given a list of lines, find all calls in this list.
-
-    :param lines list[ast]:
-    :rtype: list[Call]
-    """
-
-    calls = []
-    for tree in lines:
-        for element in ast.walk(tree):
-            if type(element) != ast.Call:
-                continue
-            call = get_call_from_func_element(element.func)
-            if call:
-                calls.append(call)
-    return calls
-
-
 def process_assign(element):
     """
     Given an element from the ast which is an assignment statement, return a
@@ -104,29 +85,34 @@ def process_import(element):
     return ret
 
 
-def make_local_variables(lines, parent):
+def make_calls_and_variables(lines, parent):
     """
-    Given an ast of all the lines in a function, generate a list of
-    variables in that function. Variables are tokens and what they link to.
-    In this case, what it links to is just a string. However, that is resolved
-    later.
+    Given a list of lines, find all calls and all variables in this list in
+    a single pass. Variables are tokens and what they link to. In this case,
+    what it links to is just a string. However, that is resolved later.
 
     :param lines list[ast]:
     :param parent Group:
-    :rtype: list[Variable]
+    :rtype: (list[Call], list[Variable])
     """
+    calls = []
     variables = []
     for tree in lines:
         for element in ast.walk(tree):
-            if type(element) == ast.Assign:
+            element_type = type(element)
+            if element_type == ast.Call:
+                call = get_call_from_func_element(element.func)
+                if call:
+                    calls.append(call)
+            elif element_type == ast.Assign:
                 variables += process_assign(element)
-            if type(element) in (ast.Import, ast.ImportFrom):
+            elif element_type in (ast.Import, ast.ImportFrom):
                 variables += process_import(element)
     if parent.group_type == GROUP_TYPE.CLASS:
         variables.append(Variable('self', parent, lines[0].lineno))
 
     variables = list(filter(None, variables))
-    return variables
+    return calls, variables
 
 
 def get_inherits(tree):
@@ -142,7 +128,7 @@ def get_inherits(tree):
 
 class Python(BaseLanguage):
     @staticmethod
-    def assert_dependencies():
+    def assert_dependencies(_):
         pass
 
     @staticmethod
@@ -202,8 +188,7 @@ class Python(BaseLanguage):
         """
         token = tree.name
         line_number = tree.lineno
-        calls = make_calls(tree.body)
-        variables = make_local_variables(tree.body, parent)
+        calls, variables = make_calls_and_variables(tree.body, parent)
         is_constructor = False
         if parent.group_type == GROUP_TYPE.CLASS and token in ['__init__', '__new__']:
             is_constructor = True
@@ -227,8 +212,7 @@ class Python(BaseLanguage):
         """
         token = "(global)"
         line_number = 0
-        calls = make_calls(lines)
-        variables = make_local_variables(lines, parent)
+        calls, variables = make_calls_and_variables(lines, parent)
         return Node(token, calls, variables, line_number=line_number, parent=parent)
 
     @staticmethod
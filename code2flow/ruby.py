@@ -1,8 +1,12 @@
-import json
+import logging
+import os
 import subprocess
 
-from .model import (Group, Node, Call, Variable, BaseLanguage,
-                    OWNER_CONST, GROUP_TYPE, is_installed, flatten)
+from .model import (Group, Node, Call, Variable, OWNER_CONST, GROUP_TYPE,
+                    is_installed, flatten)
+from .parsers import ParserPool, ParserCrashedError, PooledLanguage
+
+SCRIPT_LOC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "get_ast.rb")
 
 
 def resolve_owner(owner_el):
@@ -55,21 +59,26 @@ def get_call_from_send_el(func_el):
                 owner_token=owner)
 
 
-def walk(tree_el):
+def walk(tree_el, types=None):
     """
-    Given an ast element (list), walk it in a dfs to get every el (list) out of it
+    Given an ast element (list), walk it in a dfs to get every el (list) out of it.
+    Uses an explicit stack so deeply nested code can't hit the recursion limit.
 
     :param tree_el ast:
-    :rtype: list[ast]
+    :param tuple[str]|None types: If given, only yield els of these types
+    :rtype: iterator[ast]
     """
-
     if not tree_el:
-        return []
-    ret = [tree_el]
-    for el in tree_el:
-        if isinstance(el, list):
-            ret += walk(el)
-    return ret
+        return
+    stack = [iter((tree_el,))]
+    while stack:
+        el = next(stack[-1], None)
+        if el is None:
+            stack.pop()
+            continue
+        if types is None or el[0] in types:
+            yield el
+        stack.append(child for child in el if child and isinstance(child, list))
 
 
 def make_calls(body_el):
@@ -80,9 +89,8 @@ def make_calls(body_el):
     :rtype: list[Call]
     """
     calls = []
-    for el in walk(body_el):
-        if el[0] == 'send':
-            calls.append(get_call_from_send_el(el))
+    for el in walk(body_el, ('send',)):
+        calls.append(get_call_from_send_el(el))
     return calls
 
 
@@ -191,34 +199,83 @@ def get_inherits(tree, body_tree):
     return inherits
 
 
-class Ruby(BaseLanguage):
+def get_ruby_pool():
+    """
+    Get the pool of long-lived ruby processes which parse files with the parser gem
+    :rtype: ParserPool
+    """
+    return ParserPool.for_current_process(["ruby", SCRIPT_LOC, "--serve"])
+
+
+class Ruby(PooledLanguage):
     @staticmethod
-    def assert_dependencies():
-        """Assert that ruby-parse is installed"""
-        assert is_installed('ruby-parse'), "The 'parser' gem is requred to " \
-                                           "parse ruby files but was not found " \
-                                           "on the path. Install it from gem " \
-                                           "and try again."
+    def assert_dependencies(lang_params):
+        """
+        Assert that ruby and the parser gem are installed. The pool of ruby
+        processes is only started if we are going to parse with it.
+
+        :param lang_params LanguageParams:
+        """
+        assert_msg = "The 'parser' gem is requred to parse ruby files but " \
+                     "could not be loaded. Install it from gem and try again."
+        assert is_installed('ruby'), assert_msg
+        if not lang_params.parser_workers:
+            proc = subprocess.run(["ruby", "-e", "require 'parser'; puts Parser::VERSION"],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            assert not proc.returncode, assert_msg + "\n" + proc.stderr.decode(errors='replace')
+            version = proc.stdout.decode().strip()
+        else:
+            try:
+                version = get_ruby_pool().handshake()['version']
+            except ParserCrashedError as ex:
+                raise AssertionError(assert_msg + "\n" + str(ex)) from None
+        logging.info("Using parser gem %s", version)
+
+    @staticmethod
+    def get_pool():
+        """
+        :rtype: ParserPool
+        """
+        return get_ruby_pool()
 
     @staticmethod
-    def get_tree(filename, lang_params):
+    def get_tree_cmd(filename, lang_params):
         """
-        Get the entire AST for this file
+        The command to parse a single file with its own ruby process
 
         :param filename str:
         :param lang_params LanguageParams:
+        :rtype: list[str]
+        """
+        return ["ruby", SCRIPT_LOC, lang_params.ruby_version, filename]
+
+    @staticmethod
+    def make_request(filename, lang_params):
+        """
+        :param filename str:
+        :param lang_params LanguageParams:
+        :rtype: dict
+        """
+        return {'file': os.path.abspath(filename),
+                'ruby_version': lang_params.ruby_version}
+
+    @staticmethod
+    def parse_error(filename):
+        """
+        :param filename str:
+        :rtype: AssertionError
+        """
+        return AssertionError(
+            "Ruby-parse could not parse file %r. You may have a syntax error. "
+            "For more detail, try running the command `ruby-parse %s`. " %
+            (filename, filename))
+
+    @staticmethod
+    def check_tree(tree):
+        """
+        :param tree ast:
         :rtype: ast
         """
-        version_flag = "--" + lang_params.ruby_version
-        cmd = ["ruby-parse", "--emit-json", version_flag, filename]
-        output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
-        try:
-            tree = json.loads(output)
-        except json.decoder.JSONDecodeError:
-            raise AssertionError(
-                "Ruby-parse could not parse file %r. You may have a syntax error. "
-                "For more detail, try running the command `ruby-parse %s`. " %
-                (filename, filename)) from None
         assert isinstance(tree, list)
 
         if tree[0] not in ('module', 'begin'):
@@ -329,8 +386,7 @@ class Ruby(BaseLanguage):
         for node_tree in node_trees:
             for new_node in Ruby.make_nodes(node_tree, parent=class_group):
                 class_group.add_node(new_node)
-        for node in class_group.nodes:
-            node.variables += [Variable(n.token, n) for n in class_group.nodes]
+        class_group.member_variables = [Variable(n.token, n) for n in class_group.nodes]
 
         return class_group
 
@@ -1,16 +1,22 @@
+import ast
 import json
 import locale
 import logging
 import os
+import re
 import shutil
+import subprocess
 import sys
+import weakref
 
 import pytest
 
 sys.path.append(os.getcwd().split('/tests')[0])
 
-from code2flow.engine import code2flow, main, _generate_graphviz, SubsetParams
-from code2flow import model
+from code2flow.engine import (code2flow, main, _generate_graphviz, _parse_serially,
+                              _find_links, _find_all_links, _usable_jobs, make_file_group,
+                              ResolutionCache, SubsetParams, LanguageParams)
+from code2flow import model, parsers, javascript, php, ruby
 
 IMG_PATH = '/tmp/code2flow/output.png'
 if os.path.exists("/tmp/code2flow"):
@@ -103,6 +109,184 @@ def test_json():
     assert len(set(n['target'] for n in jobj['graph']['edges'])) == 3
 
 
+def _edge_names(json_path):
+    with open(json_path) as f:
+        graph = json.loads(f.read())['graph']
+    names = {uid: n['name'] for uid, n in graph['nodes'].items()}
+    return sorted((names[e['source']], names[e['target']]) for e in graph['edges'])
+
+
+def test_resolution_cache(caplog):
+    caplog.set_level(logging.INFO)
+    code2flow('test_code/py/pytz',
+              output_file='/tmp/code2flow/cached.json')
+    assert "Resolution cache" in caplog.text and "hit rate" in caplog.text
+    # pytz calls the same module functions from many different functions.
+    # Those must be resolved once, not once per calling function
+    hits = int(re.search(r"Resolution cache: (\d+) hits", caplog.text).group(1))
+    assert hits > 0
+    caplog.clear()
+    code2flow('test_code/py/pytz',
+              output_file='/tmp/code2flow/uncached.json',
+              resolution_cache=False)
+    assert "Resolution cache" not in caplog.text
+    assert _edge_names('/tmp/code2flow/cached.json') == _edge_names('/tmp/code2flow/uncached.json')
+
+
+def test_jobs():
+    code2flow('test_code/py/pytz',
+              output_file='/tmp/code2flow/serial.json')
+    code2flow('test_code/py/pytz',
+              output_file='/tmp/code2flow/parallel.json',
+              jobs=3)
+    assert _edge_names('/tmp/code2flow/serial.json') == _edge_names('/tmp/code2flow/parallel.json')
+
+
+def test_jobs_default(mocker):
+    code2flow_mock = mocker.patch('code2flow.engine.code2flow')
+    main(['test_code/py/simple_a'])
+    assert code2flow_mock.call_args.kwargs['jobs'] == (os.cpu_count() or 1)
+
+
+def test_usable_jobs(monkeypatch):
+    assert _usable_jobs(4, 2) == 2
+    assert _usable_jobs(4, 0) == 1
+    monkeypatch.setattr(sys, 'platform', 'darwin')
+    assert _usable_jobs(4, 10) == 1
+
+
+def test_jobs_trimmed():
+    """
+    Trimmed nodes that a member variable still points to are linked to the
+    same way with and without forking
+    """
+    file_group = model.Group('my_file', model.GROUP_TYPE.FILE, 'File', line_number=0)
+    group = model.Group('Obj', model.GROUP_TYPE.CLASS, 'Class', parent=file_group)
+    file_group.add_subgroup(group)
+    for token in ('a', 'b', 'c'):
+        group.add_node(model.Node(token, [model.Call('b')], [], group))
+    group.member_variables = [model.Variable(n.token, n) for n in group.nodes]
+    group.nodes[1].remove_from_parent()
+    all_nodes = file_group.all_nodes()
+    symbol_table = model.SymbolTable([file_group])
+
+    def links(jobs):
+        return [(a.token, b.token) for a, b, _ in
+                _find_all_links(all_nodes, symbol_table, True, jobs)]
+    assert links(1) == links(2) == [('a', 'b'), ('c', 'b')]
+
+    code2flow('test_code/py/inherits', '/tmp/code2flow/serial.json',
+              exclude_functions=['__init__'], jobs=1)
+    code2flow('test_code/py/inherits', '/tmp/code2flow/jobs.json',
+              exclude_functions=['__init__'], jobs=2)
+    assert _edge_names('/tmp/code2flow/serial.json') == _edge_names('/tmp/code2flow/jobs.json')
+
+
+def test_jobs_parse_errors():
+    with pytest.raises(AssertionError):
+        code2flow('test_code/js/bad_parse', output_file='/tmp/code2flow/out.json', jobs=2)
+    code2flow('test_code/js/bad_parse', output_file='/tmp/code2flow/serial.json',
+              skip_parse_errors=True)
+    code2flow('test_code/js/bad_parse', output_file='/tmp/code2flow/parallel.json',
+              skip_parse_errors=True, jobs=2)
+    assert _edge_names('/tmp/code2flow/serial.json') == _edge_names('/tmp/code2flow/parallel.json')
+
+
+def test_parse_serially_drops_trees(monkeypatch):
+    trees = []
+    get_tree = model.BaseLanguage.get_trees.__func__
+
+    def get_trees(cls, filenames, lang_params):
+        for filename, tree in get_tree(cls, filenames, lang_params):
+            trees.append(weakref.ref(tree))
+            yield filename, tree
+
+    monkeypatch.setattr(model.BaseLanguage, 'get_trees', classmethod(get_trees))
+    sources = sorted(os.path.join('test_code/py/pytz', f)
+                     for f in os.listdir('test_code/py/pytz') if f.endswith('.py'))
+    for _, file_group in _parse_serially(sources, 'py', LanguageParams()):
+        assert file_group.all_nodes()
+        assert all(tree() is None for tree in trees[:-1])
+    assert len(trees) == len(sources)
+
+
+def test_file_summary():
+    with open('test_code/py/inherits/inherits.py') as f:
+        tree = ast.parse(f.read())
+    file_group = make_file_group(tree, 'inherits.py', 'py')
+    rebuilt = model.FileSummary.from_file_group(file_group).to_file_group()
+    assert [g.token for g in rebuilt.all_groups()] == [g.token for g in file_group.all_groups()]
+    for node, rebuilt_node in zip(file_group.all_nodes(), rebuilt.all_nodes()):
+        assert node.token == rebuilt_node.token
+        assert node.parent.token == rebuilt_node.parent.token
+        assert [c.to_string() for c in node.calls] == [c.to_string() for c in rebuilt_node.calls]
+        assert [v.to_string() for v in node.variables] == \
+            [v.to_string() for v in rebuilt_node.variables]
+    assert rebuilt.root_node.token == '(global)'
+
+
+def test_merged_calls():
+    source = ("class Foo:\n"
+              "    def __init__(self):\n"
+              "        pass\n"
+              "def b():\n"
+              "    pass\n"
+              "def a():\n"
+              "    b()\n"
+              "    b()\n"
+              "    b = Foo()\n"
+              "    b()\n")
+    file_group = make_file_group(ast.parse(source), 'merged.py', 'py')
+    symbol_table = model.SymbolTable([file_group])
+    for node in file_group.all_nodes():
+        node.resolve_variables(symbol_table)
+    node_a = [n for n in file_group.all_nodes() if n.token == 'a'][0]
+    assert [c.to_string() for c in node_a.calls] == ['b()', 'Foo()']
+    assert node_a.calls[0].line_numbers == [7, 8, 10]
+    assert node_a.calls[0].line_number == 7
+
+    # b() on lines 7 and 8 links to b once. On line 10, b is a Foo
+    for resolution_cache in (None, ResolutionCache()):
+        links = _find_links(node_a, symbol_table, resolution_cache)
+        assert sorted(n.token_with_ownership() for n, _ in links if n) == \
+            ['Foo.__init__', 'Foo.__init__', 'b']
+
+    # Merged calls are only resolved once per node so the cache has to hit
+    # across nodes. c() and d() see the same variables for b and Foo as each other
+    source += ("def c():\n"
+               "    b()\n"
+               "    Foo()\n"
+               "def d():\n"
+               "    b()\n"
+               "    Foo()\n")
+    file_group = make_file_group(ast.parse(source), 'merged.py', 'py')
+    symbol_table = model.SymbolTable([file_group])
+    for node in file_group.all_nodes():
+        node.resolve_variables(symbol_table)
+    resolution_cache = ResolutionCache()
+    for node in file_group.all_nodes():
+        _find_links(node, symbol_table, resolution_cache)
+    assert resolution_cache.hits == 4
+
+
+def test_member_scope():
+    file_group = model.Group('my_file', model.GROUP_TYPE.FILE, 'File', line_number=0)
+    group = model.Group('Obj', model.GROUP_TYPE.CLASS, 'Class', parent=file_group)
+    file_group.add_subgroup(group)
+    for token in ('a', 'b'):
+        group.add_node(model.Node(token, [model.Call('a'), model.Call('b')], [], group))
+    group.member_variables = [model.Variable(n.token, n) for n in group.nodes]
+    node_a, node_b = group.nodes
+
+    assert node_a.get_scope().parent is node_b.get_scope().parent is group.get_member_scope()
+    assert [v.points_to for v in node_a.get_scope().lookup(('b',))] == [node_b]
+    assert not node_a.variables
+
+    rebuilt = model.FileSummary.from_file_group(file_group).to_file_group()
+    rebuilt_group = rebuilt.subgroups[0]
+    assert [v.points_to for v in rebuilt_group.member_variables] == rebuilt_group.nodes
+
+
 def test_weird_encoding():
     """
     To address https://github.com/scottrogowski/code2flow/issues/28
@@ -138,6 +322,26 @@ def test_repr():
     print(edge)
 
 
+def test_slots():
+    group = model.Group('Obj', model.GROUP_TYPE.CLASS, 'Class', line_number=0)
+    call = model.Call('tostring', 42, 'obj')
+    node = model.Node('tostring', [call], [], group, line_number=13)
+    for obj in (group, call, model.Variable('the_string', call, 42), node,
+                model.Edge(node, node), node.get_scope()):
+        assert not hasattr(obj, '__dict__')
+        with pytest.raises(AttributeError):
+            obj.ad_hoc = True
+
+
+def test_interned_tokens():
+    call_a = model.Call(''.join(['to', 'string']), 1, ''.join(['o', 'bj']))
+    call_b = model.Call(''.join(['tos', 'tring']), 2, ''.join(['ob', 'j']))
+    assert call_a.token is call_b.token
+    assert call_a.owner_token is call_b.owner_token
+    assert model.Variable(''.join(['o', 'bj']), call_a).token is call_a.owner_token
+    assert model.djoin('a', 'b') is model.djoin(['a', 'b'])
+
+
 def test_bad_acorn(mocker, caplog):
     caplog.set_level(logging.DEBUG)
     mocker.patch('code2flow.javascript.get_acorn_version', return_value='7.6.9')
@@ -145,13 +349,225 @@ def test_bad_acorn(mocker, caplog):
     assert "Acorn" in caplog.text and "8.*" in caplog.text
 
 
+def test_js_dependencies(mocker):
+    """
+    The node worker is only started to check dependencies if we are going
+    to parse with it
+    """
+    mocker.patch('code2flow.javascript.is_installed', return_value=True)
+    pool = mocker.patch('code2flow.javascript.get_acorn_pool')
+    pool.return_value.handshake.return_value = {'version': '8.0.0'}
+    run = mocker.patch('code2flow.javascript.subprocess.run',
+                       return_value=subprocess.CompletedProcess([], 0, b'8.0.0\n', b''))
+    javascript.Javascript.assert_dependencies(LanguageParams(parser_workers=0))
+    assert run.called and not pool.called
+    javascript.Javascript.assert_dependencies(LanguageParams())
+    assert pool.return_value.handshake.called
+
+    mocker.patch('code2flow.javascript.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 1, b'', b'Cannot find module'))
+    with pytest.raises(AssertionError) as ex:
+        javascript.Javascript.assert_dependencies(LanguageParams(parser_workers=0))
+    assert "could not be imported" in str(ex.value)
+
+
+def test_acorn_worker_crash(mocker, caplog):
+    mocker.patch('code2flow.javascript.get_acorn_version', return_value='8.0.0')
+    mocker.patch('code2flow.javascript.get_acorn_pool',
+                 return_value=parsers.ParserPool(['node', '-e', 'process.exit(1)']))
+    code2flow("test_code/js/chained", "/tmp/code2flow/crashed.json")
+    assert "Falling back" in caplog.text
+    code2flow("test_code/js/chained", "/tmp/code2flow/per_file.json",
+              lang_params=LanguageParams(parser_workers=0))
+    assert _edge_names('/tmp/code2flow/crashed.json') == _edge_names('/tmp/code2flow/per_file.json')
+    assert _edge_names('/tmp/code2flow/crashed.json')
+
+
+def test_parser_handshake_crash(mocker):
+    close = mocker.spy(parsers.ParserProcess, 'close')
+    pool = parsers.ParserPool([sys.executable, '-c', 'print("not a frame")'])
+    with pytest.raises(parsers.ParserCrashedError):
+        pool.handshake()
+    assert close.call_count == 1
+    assert not pool.processes
+
+
+def test_pool_for_current_process(monkeypatch):
+    cmd = [sys.executable, '-c', 'pass']
+    pool = parsers.ParserPool.for_current_process(cmd)
+    assert parsers.ParserPool.for_current_process(list(cmd)) is pool
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    assert parsers.ParserPool.for_current_process(cmd) is not pool
+
+
+def test_acorn_ir():
+    """
+    The acorn worker sends a compact IR instead of the AST. It must build
+    exactly what the AST would
+    """
+    for directory in ('moment', 'chained', 'inheritance', 'scoping', 'weird_assignments'):
+        code2flow("test_code/js/" + directory, "/tmp/code2flow/ir.json", no_trimming=True)
+        code2flow("test_code/js/" + directory, "/tmp/code2flow/ast.json", no_trimming=True,
+                  lang_params=LanguageParams(parser_workers=0))
+        with open('/tmp/code2flow/ir.json') as f:
+            ir_nodes = sorted(n['name'] for n in json.load(f)['graph']['nodes'].values())
+        with open('/tmp/code2flow/ast.json') as f:
+            ast_nodes = sorted(n['name'] for n in json.load(f)['graph']['nodes'].values())
+        assert ir_nodes == ast_nodes
+        assert _edge_names('/tmp/code2flow/ir.json') == _edge_names('/tmp/code2flow/ast.json')
+
+
+def test_acorn_unsupported():
+    """
+    Code that acorn parses but code2flow doesn't support isn't reported as
+    a syntax error
+    """
+    with open('/tmp/code2flow/unsupported.js', 'w') as f:
+        f.write("class A extends mixin(B) {}\n")
+    with pytest.raises(AssertionError) as ex:
+        code2flow('/tmp/code2flow/unsupported.js', '/tmp/code2flow/out.json')
+    assert "does not support" in str(ex.value) and "superclass on line 1" in str(ex.value)
+    assert "syntax" not in str(ex.value)
+
+    with pytest.raises(AssertionError) as ex:
+        code2flow('test_code/js/bad_parse', '/tmp/code2flow/out.json')
+    assert "syntax" in str(ex.value)
+
+
+def test_js_deep_nesting():
+    """
+    walk and separate_namespaces don't recurse so deeply nested code is fine
+    """
+    call = {'type': 'CallExpression', 'callee': {'type': 'Identifier', 'name': 'a'}}
+    tree = {'type': 'Program', 'body': [call]}
+    for _ in range(sys.getrecursionlimit() * 2):
+        tree = {'type': 'BlockStatement', 'body': [tree]}
+    tree = {'type': 'Program', 'body': [tree]}
+    assert list(javascript.walk(tree, ('CallExpression',))) == [call]
+    groups, nodes, body = javascript.Javascript.separate_namespaces(tree)
+    assert not groups and not nodes and body == tree['body']
+
+    # The acorn worker's IR walk. Deep enough to overflow a recursive walk
+    # but not acorn's own parser
+    depth = 2500
+    with open('/tmp/code2flow/deep_nesting.js', 'w') as f:
+        f.write("function a() {}\nfunction b() {%sa()%s}\n" % ('{' * depth, '}' * depth))
+    code2flow('/tmp/code2flow/deep_nesting.js', '/tmp/code2flow/deep_nesting.json')
+    assert _edge_names('/tmp/code2flow/deep_nesting.json') == [('deep_nesting::b', 'deep_nesting::a')]
+
+
+def test_ruby_php_deep_nesting():
+    depth = sys.getrecursionlimit() * 2
+    send = ['send', None, 'a']
+    tree = send
+    for _ in range(depth):
+        tree = ['begin', tree]
+    assert list(ruby.walk(tree, ('send',))) == [send]
+
+    call = {'nodeType': 'Expr_FuncCall', 'name': {'nodeType': 'Name', 'parts': ['a']}}
+    tree = call
+    for _ in range(depth):
+        tree = {'nodeType': 'Stmt_If', 'stmts': [tree]}
+    assert list(php.walk([tree], php.CALL_NODE_TYPES)) == [call]
+    groups, nodes, body = php.PHP.separate_namespaces([tree])
+    assert not groups and not nodes and body == [tree]
+
+
+def _ruby_parser_installed():
+    if not shutil.which('ruby'):
+        return False
+    return not subprocess.run(['ruby', '-e', "require 'parser'"], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).returncode
+
+
+def test_ruby_dependencies(mocker):
+    """
+    The pool of ruby processes is only started to check dependencies if
+    we are going to parse with it
+    """
+    mocker.patch('code2flow.ruby.is_installed', return_value=True)
+    pool = mocker.patch('code2flow.ruby.get_ruby_pool')
+    mocker.patch('code2flow.ruby.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 0, b'3.2.2.4\n', b''))
+    ruby.Ruby.assert_dependencies(LanguageParams(parser_workers=0))
+    assert not pool.called
+    ruby.Ruby.assert_dependencies(LanguageParams())
+    assert pool.return_value.handshake.called
+
+    mocker.patch('code2flow.ruby.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 1, b'', b'LoadError'))
+    with pytest.raises(AssertionError) as ex:
+        ruby.Ruby.assert_dependencies(LanguageParams(parser_workers=0))
+    assert "parser" in str(ex.value)
+
+
+@pytest.mark.skipif(not _ruby_parser_installed(), reason="ruby or the parser gem is not installed")
+def test_ruby_pool():
+    """
+    The pool of ruby processes must build exactly what a process per file builds
+    """
+    for directory in sorted(os.listdir('test_code/rb')):
+        code2flow("test_code/rb/" + directory, "/tmp/code2flow/pool.json", no_trimming=True)
+        code2flow("test_code/rb/" + directory, "/tmp/code2flow/per_file.json", no_trimming=True,
+                  lang_params=LanguageParams(parser_workers=0))
+        assert _edge_names('/tmp/code2flow/pool.json') == _edge_names('/tmp/code2flow/per_file.json')
+
+
 def test_bad_ruby_parse(mocker):
-    mocker.patch('subprocess.check_output', return_value=b'blah blah')
+    mocker.patch('code2flow.parsers.run_parser_subprocesses',
+                 side_effect=lambda cmds, _: ((0, b'blah blah') for cmd in cmds))
     with pytest.raises(AssertionError) as ex:
-        code2flow("test_code/rb/simple_b", "/tmp/code2flow/out.json")
+        code2flow("test_code/rb/simple_b", "/tmp/code2flow/out.json",
+                  lang_params=LanguageParams(parser_workers=0))
         assert "ruby-parse" in ex and "syntax" in ex
 
 
+def _php_parser_installed():
+    vendor = os.path.join(os.path.dirname(os.path.abspath(php.__file__)), 'vendor')
+    return bool(shutil.which('php')) and os.path.isdir(vendor)
+
+
+def test_php_dependencies(mocker):
+    """
+    The pool of php processes is only started to check dependencies if
+    we are going to parse with it. Only php-parser 4 is supported.
+    """
+    mocker.patch('code2flow.php.is_installed', return_value=True)
+    pool = mocker.patch('code2flow.php.get_php_pool')
+    pool.return_value.handshake.return_value = {'version': '8.1.2', 'parser_version': 'v4.15.4'}
+    run = mocker.patch('code2flow.php.subprocess.run', return_value=subprocess.CompletedProcess(
+        [], 0, b'{"version": "8.1.2", "parser_version": "v4.15.4"}\n', b''))
+    php.PHP.assert_dependencies(LanguageParams(parser_workers=0))
+    assert run.called and not pool.called
+    php.PHP.assert_dependencies(LanguageParams())
+    assert pool.return_value.handshake.called
+
+    pool.return_value.handshake.return_value = {'version': '8.3.0', 'parser_version': 'v5.0.2'}
+    with pytest.raises(AssertionError) as ex:
+        php.PHP.assert_dependencies(LanguageParams())
+    assert "^4.10" in str(ex.value) and "5.0.2" in str(ex.value)
+
+    mocker.patch('code2flow.php.subprocess.run',
+                 return_value=subprocess.CompletedProcess([], 255, b'', b'Fatal error'))
+    with pytest.raises(AssertionError) as ex:
+        php.PHP.assert_dependencies(LanguageParams(parser_workers=0))
+    assert "php-parser" in str(ex.value)
+
+
+@pytest.mark.skipif(not _php_parser_installed(), reason="php or php-parser is not installed")
+def test_php_pool():
+    """
+    The pool of php processes must build exactly what a process per file builds
+    """
+    for directory in sorted(os.listdir('test_code/php')):
+        if directory == 'bad_php':
+            continue
+        code2flow("test_code/php/" + directory, "/tmp/code2flow/pool.json", no_trimming=True)
+        code2flow("test_code/php/" + directory, "/tmp/code2flow/per_file.json", no_trimming=True,
+                  lang_params=LanguageParams(parser_workers=0))
+        assert _edge_names('/tmp/code2flow/pool.json') == _edge_names('/tmp/code2flow/per_file.json')
+
+
 def test_bad_php_parse_a():
     with pytest.raises(AssertionError) as ex:
         code2flow("test_code/php/bad_php/bad_php_a.php", "/tmp/code2flow/out.json")